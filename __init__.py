@@ -1,21 +1,7 @@
-from krita import DockWidgetFactory, DockWidgetFactoryBase, Krita
-from .project_manager_docker import ProjectManagerDocker
-from .project_setup_wizard import ProjectSetupExtension
-from .translate_docker import TranslateDocker
+import importlib.util
+import multiprocessing
 
-
-instance = Krita.instance()
-
-dock_widget_factory = DockWidgetFactory('project_manager_docker',
-                                        DockWidgetFactoryBase.DockRight,
-                                        ProjectManagerDocker)
-instance.addDockWidgetFactory(dock_widget_factory)
-
-
-dock_widget_factory = DockWidgetFactory('translate_docker',
-                                        DockWidgetFactoryBase.DockRight,
-                                        TranslateDocker)
-instance.addDockWidgetFactory(dock_widget_factory)
-
-
-instance.addExtension(ProjectSetupExtension(Krita.instance()))
\ No newline at end of file
+# Worker processes (see commons/executor.py) and command line tools (see export.py) import this
+# package too. They run outside of Krita and must not register any extensions.
+if multiprocessing.parent_process() is None and importlib.util.find_spec("krita") is not None:
+    from . import plugin
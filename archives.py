@@ -0,0 +1,118 @@
+"""Import pages straight from ZIP/CBZ archives.
+
+Entries are listed from the archive's directory in natural order ("2.png" before "10.png").
+When importing, each entry is read and decoded from memory on the thread pool, a few pages
+ahead of Krita, and turned into a document without extracting anything to disk.
+"""
+from __future__ import annotations
+import re
+from collections import deque
+from concurrent.futures import Future
+from pathlib import Path, PurePosixPath
+from typing import Iterator, NamedTuple, Union
+from PyQt5.QtGui import QImage
+
+from .commons.image import Image
+from .commons.util import ZipFile
+from .commons import executor
+from .datatypes import ORIG_LAYER_NAME
+
+ARCHIVE_SUFFIXES = (".zip", ".cbz")
+IMAGE_SUFFIXES = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".webp")
+# Entries decoded ahead of the page Krita is importing
+IMPORT_WINDOW = 4
+
+
+class ArchiveEntry(NamedTuple):
+    archive: Path
+    name: str  # path inside the archive
+
+    @property
+    def filename(self):
+        return PurePosixPath(self.name).name
+
+    def __str__(self):
+        return f"{self.archive.name}/{self.name}"
+
+
+Source = Union[Path, ArchiveEntry]
+
+
+def is_archive(path: Union[Path, str]):
+    return Path(path).suffix.lower() in ARCHIVE_SUFFIXES
+
+
+def natural_key(name: str):
+    return [int(part) if part.isdigit() else part.casefold() for part in re.split(r"(\d+)", name)]
+
+
+def list_entries(archive: Path) -> list[ArchiveEntry]:
+    """Image entries of an archive in natural order. Only reads the archive's directory."""
+    with ZipFile(archive) as zip:
+        names = [
+            info.filename
+            for info in zip.infolist()
+            if not info.is_dir()
+            and PurePosixPath(info.filename).suffix.lower() in IMAGE_SUFFIXES
+            and not any(p.startswith(".") or p == "__MACOSX" for p in PurePosixPath(info.filename).parts)
+        ]
+    return [ArchiveEntry(archive, name) for name in sorted(names, key=natural_key)]
+
+
+def expand_sources(files: list[str]) -> list[Source]:
+    """Selected files with archives replaced by their image entries."""
+    sources: list[Source] = []
+    for file in files:
+        path = Path(file)
+        sources.extend(list_entries(path) if is_archive(path) else [path])
+    return sources
+
+
+def decode_entry(zip: ZipFile, name: str) -> Image:
+    """Runs on worker threads, zip files can be read from several threads at once."""
+    image = Image.from_bytes(zip.read(name), PurePosixPath(name).suffix.lstrip(".").lower())
+    # Krita expects BGRA, raws are often grayscale or indexed
+    return Image(image._qimage.convertToFormat(QImage.Format.Format_ARGB32))
+
+
+def decode_sources(sources: list[Source]) -> Iterator[tuple[Source, Image | None]]:
+    """Yield sources in order with the decoded image of archive entries (None for files, Krita
+    opens those itself). Every archive is opened once and each entry is read once."""
+    archives: dict[Path, ZipFile] = {}
+    queued: deque[tuple[Source, Future[Image] | None]] = deque()
+
+    def submit(source: Source):
+        if isinstance(source, ArchiveEntry):
+            if source.archive not in archives:
+                archives[source.archive] = ZipFile(source.archive)
+            queued.append((source, executor.submit(decode_entry, archives[source.archive], source.name)))
+        else:
+            queued.append((source, None))
+
+    try:
+        for source in sources[:IMPORT_WINDOW]:
+            submit(source)
+        for i in range(len(sources)):
+            source, future = queued.popleft()
+            if i + IMPORT_WINDOW < len(sources):
+                submit(sources[i + IMPORT_WINDOW])
+            yield source, future.result() if future else None
+    finally:
+        executor.cancel_all([f for _, f in queued if f])
+        for _, future in queued:
+            if future and not future.cancelled():
+                future.exception()  # wait for running reads before closing their archive
+        for zip in archives.values():
+            zip.close()
+
+
+def create_document(krita_inst, name: str, image: Image):
+    """Krita document holding `image` as its only layer."""
+    qimage = image._qimage
+    dpi = round(qimage.dotsPerMeterX() * 0.0254) or 72
+    doc = krita_inst.createDocument(image.width, image.height, name, "RGBA", "U8", "", float(dpi))
+    layer = doc.rootNode().childNodes()[0]
+    layer.setName(ORIG_LAYER_NAME)
+    layer.setPixelData(image.data, 0, 0, image.width, image.height)
+    doc.refreshProjection()
+    return doc
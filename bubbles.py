@@ -0,0 +1,163 @@
+"""Speech bubble detection.
+
+Bubbles are bright regions of the page enclosed by their outline, with dark text inside.
+Pixels are thresholded and encoded as horizontal runs strip by strip, so the page never exists
+as one large array. Runs which touch in adjacent rows are labeled as one connected component,
+components with the size and shape of a bubble are kept.
+
+This module must not import krita or PyQt5, `detect` runs in worker processes.
+"""
+from __future__ import annotations
+from typing import NamedTuple
+import numpy as np
+
+# Minimum gray value (0-255) of bubble background
+BRIGHT_THRESHOLD = 230
+# Bubbles smaller than this (in pixels) are specks or gaps between lines
+MIN_AREA = 1500
+# Largest bubble width/height relative to the page width, bigger regions are blank panels
+MAX_SIZE = 0.8
+# Bright pixels relative to the filled outline. Text lowers it, blank regions are close to 1
+MIN_FILL = 0.5
+MAX_FILL = 0.99
+# Filled outline relative to the bounding box, an ellipse has ~0.79
+MIN_SOLIDITY = 0.5
+
+
+class Runs(NamedTuple):
+    """Horizontal runs of bright pixels, sorted by row and column."""
+
+    y: np.ndarray  # row of each run
+    x0: np.ndarray  # first column
+    x1: np.ndarray  # column after the last
+
+    def __len__(self):
+        return len(self.y)
+
+    @staticmethod
+    def concat(parts: list[Runs]):
+        if not parts:
+            empty = np.zeros(0, np.int32)
+            return Runs(empty, empty, empty)
+        return Runs(*(np.concatenate(arrays) for arrays in zip(*parts)))
+
+
+class Bubble(NamedTuple):
+    x: int
+    y: int
+    width: int
+    height: int
+    pixels: bytes  # BGRA, white and opaque inside the bubble, transparent outside
+
+    @property
+    def bounds(self):
+        return (self.x, self.y, self.width, self.height)
+
+
+def threshold(pixels: np.ndarray, level=BRIGHT_THRESHOLD):
+    """Bright pixels of BGRA data with shape (height, width, 4), using Qt's qGray weights."""
+    b, g, r = (pixels[..., i].astype(np.uint16) for i in range(3))
+    return r * 11 + g * 16 + b * 5 >= level * 32
+
+
+def find_runs(bright: np.ndarray, y=0, x=0):
+    """Run-length encode a boolean array. `y` and `x` are the offset of the strip in the page,
+    strips must be passed in order from top to bottom and span the full page width."""
+    edges = np.diff(bright.view(np.int8), axis=1, prepend=0, append=0)
+    rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return Runs((rows + y).astype(np.int32), (starts + x).astype(np.int32), (ends + x).astype(np.int32))
+
+
+def label_runs(runs: Runs, width: int):
+    """Connected component label of each run. Labels are the index of the component's first
+    run. Runs connect if they overlap in adjacent rows (4-connectivity)."""
+    n = len(runs)
+    stride = width + 1
+    row = runs.y.astype(np.int64) * stride
+    start_key = row + runs.x0
+    end_key = row + runs.x1
+    # Runs of the next row overlapping [x0, x1) form a contiguous range of the sorted keys
+    below = row + stride
+    lo = np.searchsorted(end_key, below + runs.x0, side="right")
+    hi = np.searchsorted(start_key, below + runs.x1, side="left")
+    counts = np.maximum(hi - lo, 0)
+    src = np.repeat(np.arange(n), counts)
+    dst = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+    # Hook roots onto the smaller root of each connected pair, then compress paths until every
+    # run points at its root. Repeat until all pairs agree.
+    parent = np.arange(n)
+    while len(src) > 0:
+        a, b = parent[src], parent[dst]
+        differ = a != b
+        if not differ.any():
+            break
+        src, dst, a, b = src[differ], dst[differ], a[differ], b[differ]
+        np.minimum.at(parent, np.maximum(a, b), np.minimum(a, b))
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parent = grand
+    return parent
+
+
+def detect(runs: Runs, extent: tuple[int, int]) -> list[Bubble]:
+    """Find bubbles among the bright runs of a page with the given (width, height)."""
+    width, height = extent
+    if len(runs) == 0:
+        return []
+    _, comp = np.unique(label_runs(runs, width), return_inverse=True)
+    k = comp.max() + 1
+    area = np.bincount(comp, weights=runs.x1 - runs.x0, minlength=k)
+    left = np.full(k, width, np.int32)
+    np.minimum.at(left, comp, runs.x0)
+    right = np.zeros(k, np.int32)
+    np.maximum.at(right, comp, runs.x1)
+    top = np.full(k, height, np.int32)
+    np.minimum.at(top, comp, runs.y)
+    bottom = np.zeros(k, np.int32)
+    np.maximum.at(bottom, comp, runs.y + 1)
+
+    # Regions touching the page border are margins and gutters
+    max_size = MAX_SIZE * width
+    keep = (area >= MIN_AREA) & (left > 0) & (top > 0) & (right < width) & (bottom < height)
+    keep &= (right - left <= max_size) & (bottom - top <= max_size)
+    if not keep.any():
+        return []
+
+    # Fill each row of a component from its leftmost to its rightmost pixel, this closes the
+    # holes left by the text
+    kept = keep[comp]
+    key = comp[kept].astype(np.int64) * height + runs.y[kept]
+    span_key, span = np.unique(key, return_inverse=True)
+    span_left = np.full(len(span_key), width, np.int32)
+    np.minimum.at(span_left, span, runs.x0[kept])
+    span_right = np.zeros(len(span_key), np.int32)
+    np.maximum.at(span_right, span, runs.x1[kept])
+    span_comp = span_key // height
+    span_y = (span_key % height).astype(np.int32)
+    filled = np.bincount(span_comp, weights=span_right - span_left, minlength=k)
+
+    box = (right - left).astype(np.int64) * (bottom - top)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fill = area / filled
+        solidity = filled / box
+    keep &= (fill >= MIN_FILL) & (fill <= MAX_FILL) & (solidity >= MIN_SOLIDITY)
+
+    bubbles = []
+    for c in np.flatnonzero(keep):
+        begin, end = np.searchsorted(span_comp, [c, c + 1])
+        x, y = int(left[c]), int(top[c])
+        w, h = int(right[c]) - x, int(bottom[c]) - y
+        steps = np.zeros((h, w + 1), np.int8)
+        rows = span_y[begin:end] - y
+        steps[rows, span_left[begin:end] - x] = 1
+        steps[rows, span_right[begin:end] - x] = -1
+        inside = np.cumsum(steps, axis=1, dtype=np.int8)[:, :w] > 0
+        pixels = np.zeros((h, w, 4), np.uint8)
+        pixels[inside] = 255
+        bubbles.append(Bubble(x, y, w, h, pixels.tobytes()))
+    bubbles.sort(key=lambda b: (b.y, b.x))
+    return bubbles
@@ -0,0 +1,81 @@
+"""Fill masked regions with the background around them to paint out the original text.
+
+Most masks cover text on a flat background (bubble interiors, captions), those are filled with
+the dominant color of the masked pixels. If no color dominates, the region is filled by
+diffusing the colors just outside the mask inwards, which works for gradients and soft shading.
+Only the mask's bounds (plus a small border) are processed.
+
+This module must not import krita or PyQt5, `fill` runs on worker threads.
+"""
+from __future__ import annotations
+import numpy as np
+
+# Share of masked pixels which must fall into the most common color bin to use a flat fill
+DOMINANT_SHARE = 0.6
+# Color bins have 16 levels per channel
+QUANT_SHIFT = 4
+# Pixels around the mask which are read as known colors for diffusion
+BORDER = 2
+# Smoothing iterations per pyramid level of the diffusion fill
+DIFFUSE_ITERATIONS = 24
+
+
+def dominant_color(pixels: np.ndarray):
+    """Most common color of BGR(A) pixels with shape (n, channels), and the share of pixels
+    which have it. The color is the exact average of its bin."""
+    q = (pixels[:, :3] >> QUANT_SHIFT).astype(np.int32)
+    levels = 256 >> QUANT_SHIFT
+    key = (q[:, 0] * levels + q[:, 1]) * levels + q[:, 2]
+    counts = np.bincount(key, minlength=levels**3)
+    best = int(counts.argmax())
+    color = pixels[key == best, :3].mean(axis=0)
+    return color, counts[best] / len(pixels)
+
+
+def diffuse(values: np.ndarray, known: np.ndarray, iterations=DIFFUSE_ITERATIONS) -> np.ndarray:
+    """Fill unknown pixels of float `values` (height, width, channels) with the average of their
+    neighbours (harmonic fill). Solved coarse to fine, so large regions converge quickly."""
+    h, w, c = values.shape
+    if min(h, w) > 8:
+        # Half resolution, each pixel is the average of the known pixels in its 2x2 block
+        hh, hw = (h + 1) // 2, (w + 1) // 2
+        v = np.zeros((hh * 2, hw * 2, c), np.float32)
+        k = np.zeros((hh * 2, hw * 2), np.float32)
+        v[:h, :w] = values * known[..., None]
+        k[:h, :w] = known
+        weight = k.reshape(hh, 2, hw, 2).sum(axis=(1, 3))
+        sums = v.reshape(hh, 2, hw, 2, c).sum(axis=(1, 3))
+        coarse_known = weight > 0
+        coarse = sums / np.maximum(weight, 1)[..., None]
+        coarse = diffuse(coarse, coarse_known, iterations)
+        start = coarse.repeat(2, axis=0).repeat(2, axis=1)[:h, :w]
+    else:
+        start = np.broadcast_to(values[known].mean(axis=0), values.shape)
+
+    result = np.where(known[..., None], values, start).astype(np.float32)
+    for _ in range(iterations):
+        p = np.pad(result, ((1, 1), (1, 1), (0, 0)), mode="edge")
+        average = (p[:-2, 1:-1] + p[2:, 1:-1] + p[1:-1, :-2] + p[1:-1, 2:]) * 0.25
+        result = np.where(known[..., None], values, average)
+    return result
+
+
+def fill(art: bytes, alpha: bytes, extent: tuple[int, int]) -> bytes:
+    """Compute the patch covering a mask. `art` is BGRA and `alpha` the mask's coverage, both
+    of the given (width, height). Returns BGRA with the fill color and the mask's alpha."""
+    w, h = extent
+    bgra = np.frombuffer(art, np.uint8).reshape(h, w, 4)
+    coverage = np.frombuffer(alpha, np.uint8).reshape(h, w)
+    inside = coverage > 0
+    result = np.zeros((h, w, 4), np.uint8)
+    if not inside.any():
+        return result.tobytes()
+
+    color, share = dominant_color(bgra[inside])
+    if share >= DOMINANT_SHARE or inside.all():
+        result[..., :3] = np.rint(color).astype(np.uint8)
+    else:
+        filled = diffuse(bgra[..., :3].astype(np.float32), ~inside)
+        result[..., :3] = np.clip(np.rint(filled), 0, 255).astype(np.uint8)
+    result[..., 3] = coverage
+    return result.tobytes()
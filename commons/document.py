@@ -4,11 +4,11 @@ from typing import Literal, cast
 from weakref import WeakValueDictionary
 import krita
 from krita import Krita
-from PyQt5.QtCore import QObject, QUuid, QByteArray, QTimer, pyqtSignal
-from PyQt5.QtGui import QImage
+from PyQt5.QtCore import QObject, QUuid, QByteArray, pyqtSignal
 
-from .image import Extent, Bounds, Mask, Image
+from .image import Extent, Bounds, Mask, Image, TilePool, TILE_EXTENT, read_tiles
 from .layer import Layer, LayerManager, LayerType
+from . import scheduler
 
 
 class Document(QObject):
@@ -93,13 +93,13 @@ class Document(QObject):
 
 class KritaDocument(Document):
     """Wrapper around a Krita Document (opened image). Allows to retrieve and modify pixel data.
-    Keeps track of selection and current time changes by polling at a fixed interval.
+    Keeps track of selection and current time changes by polling while the document is active.
     """
 
     _doc: krita.Document
     _id: QUuid
     _layers: LayerManager
-    _poller: QTimer
+    _poller: scheduler.PollTask
     _selection_bounds: Bounds | None = None
     _current_time: int = 0
     _instances: WeakValueDictionary[str, KritaDocument] = WeakValueDictionary()
@@ -108,10 +108,7 @@ class KritaDocument(Document):
         super().__init__()
         self._doc = krita_document
         self._id = krita_document.rootNode().uniqueId()
-        self._poller = QTimer()
-        self._poller.setInterval(20)
-        self._poller.timeout.connect(self._poll)
-        self._poller.start()
+        self._poller = scheduler.register(self._poll, 20, priority=5)
         self._instances[self._id.toString()] = self
         self._layers = LayerManager(krita_document)
 
@@ -120,10 +117,15 @@ class KritaDocument(Document):
         if doc := Krita.instance().activeDocument():
             if doc not in Krita.instance().documents() or doc.activeNode() is None:
                 return None
-            id = doc.rootNode().uniqueId().toString()
-            return cls._instances.get(id) or KritaDocument(doc)
+            return cls.wrap(doc)
         return None
 
+    @classmethod
+    def wrap(cls, krita_document: krita.Document):
+        """Wrapper for any open document, including ones opened without a view."""
+        id = krita_document.rootNode().uniqueId().toString()
+        return cls._instances.get(id) or KritaDocument(krita_document)
+
     @property
     def extent(self):
         return Extent(self._doc.width(), self._doc.height())
@@ -185,13 +187,20 @@ class KritaDocument(Document):
             self._doc.refreshProjection()
 
         bounds = bounds or Bounds(0, 0, self._doc.width(), self._doc.height())
-        img = QImage(self._doc.pixelData(*bounds), *bounds.extent, QImage.Format.Format_ARGB32)
+        img = Image.from_buffer(self._doc.pixelData(*bounds), bounds.extent)
 
         for layer in excluded:
             layer.show()
         if len(excluded) > 0:
             self._doc.refreshProjection()
-        return Image(img)
+        return img
+
+    def tiles(
+        self, bounds: Bounds | None = None, tile=TILE_EXTENT, overlap=0, pool: TilePool | None = None
+    ):
+        """Stream the document projection in tiles instead of one large image, see `read_tiles`."""
+        bounds = bounds or Bounds(0, 0, self._doc.width(), self._doc.height())
+        return read_tiles(self._doc.pixelData, bounds, 4, tile, overlap, pool)
 
     def resize(self, extent: Extent):
         res = self._doc.resolution()
@@ -239,16 +248,22 @@ class KritaDocument(Document):
 
     def _poll(self):
         if self.is_valid:
+            if not self.is_active:
+                return False  # Inactive documents don't change selection, let the poll back off
+            changed = False
             selection = self._doc.selection()
             selection_bounds = _selection_bounds(selection) if selection else None
             if selection_bounds != self._selection_bounds:
                 self._selection_bounds = selection_bounds
                 self.selection_bounds_changed.emit()
+                changed = True
 
             current_time = self.current_time
             if current_time != self._current_time:
                 self._current_time = current_time
                 self.current_time_changed.emit()
+                changed = True
+            return changed
         else:
             self._poller.stop()
 
@@ -270,6 +285,9 @@ def _selection_is_entire_document(selection: krita.Selection, extent: Extent):
         return False
     if bounds.width + bounds.x < extent.width or bounds.height + bounds.y < extent.height:
         return False
-    mask = selection.pixelData(*bounds)
-    is_opaque = all(x == b"\xff" for x in mask)
-    return is_opaque
+    # Stream in strips, most selections can be rejected after the first one
+    strip = Extent(bounds.width, max(1, (1 << 22) // max(bounds.width, 1)))
+    for tile in read_tiles(selection.pixelData, bounds, 1, strip):
+        if not (tile.data == 255).all():
+            return False
+    return True
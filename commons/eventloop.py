@@ -1,46 +1,136 @@
 import asyncio
+import sys
+from collections import deque
 from typing import Callable
-from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
 
-_loop = asyncio.new_event_loop()
-_timer = QTimer()
+from .util import client_logger as log
 
 
-def process_python_events():
-    if not _loop.is_running():
-        _loop.call_soon(lambda: _loop.stop())
-        _loop.run_forever()
+class _Waker(QObject):
+    # Emitted from other threads, delivered as queued call on the UI thread
+    wake = pyqtSignal()
 
 
-def setup():
-    assert _timer is not None
-    _timer.setInterval(20)
-    _timer.timeout.connect(process_python_events)
-    _timer.start()
+# Platform default loop, only the proactor loop can run subprocesses on Windows
+_BaseLoop = asyncio.ProactorEventLoop if sys.platform == "win32" else asyncio.SelectorEventLoop
+# Python versions whose loop internals (ready queue, timer heap, selector / proactor cache) were
+# checked. With other versions, or if the attributes are missing, the loop is pumped by a timer.
+_INSPECTED_VERSIONS = ((3, 8), (3, 13))
 
 
-def run(future):
-    task = None
+def _can_inspect(loop: asyncio.AbstractEventLoop):
+    if not _INSPECTED_VERSIONS[0] <= sys.version_info[:2] <= _INSPECTED_VERSIONS[1]:
+        return False
+    if not isinstance(getattr(loop, "_ready", None), deque):
+        return False
+    if not isinstance(getattr(loop, "_scheduled", None), list):
+        return False
+    if proactor := getattr(loop, "_proactor", None):
+        return hasattr(proactor, "_cache") and hasattr(proactor, "_unregistered")
+    return hasattr(getattr(loop, "_selector", None), "get_map")
 
-    def schedule():
-        nonlocal task
-        task = _loop.create_task(future)
-        _loop.stop()
 
-    if not _loop.is_running():
-        _loop.call_soon(schedule)
-        _loop.run_forever()
-    else:
-        task = _loop.create_task(future)
+class QtEventLoop(_BaseLoop):
+    """Asyncio event loop which runs inside the Qt event loop. Each iteration is triggered by a
+    single-shot QTimer: immediately when callbacks are ready, at the due time of the next timed
+    callback, and not at all while there is nothing to do.
+    Deciding this needs a look at asyncio internals. On Python versions where they weren't
+    checked, the loop runs every `io_poll_interval` ms instead, like a plain timer pump.
+    """
+
+    # Poll interval while I/O (eg. subprocess pipes) is pending, which Qt can't see
+    io_poll_interval = 20
+
+    def __init__(self):
+        super().__init__()
+        self._timer = QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self.process_events)
+        self._waker = _Waker()
+        self._inspect = _can_inspect(self)
+        if not self._inspect:
+            log.warning(f"Unknown asyncio internals in Python {sys.version_info[:2]}, polling the event loop")
+        self._waker.wake.connect(lambda: self._wakeup(0))
+
+    def call_soon(self, callback, *args, context=None):
+        handle = super().call_soon(callback, *args, context=context)
+        self._wakeup(0)
+        return handle
+
+    def call_at(self, when, callback, *args, context=None):
+        handle = super().call_at(when, callback, *args, context=context)
+        self._wakeup(int(max(0.0, when - self.time()) * 1000))
+        return handle
+
+    def call_soon_threadsafe(self, callback, *args, context=None):
+        handle = super().call_soon_threadsafe(callback, *args, context=context)
+        self._waker.wake.emit()
+        return handle
+
+    def process_events(self):
+        """Run one iteration of the asyncio loop, then schedule the next one if needed."""
+        if self.is_closed():
+            return
+        if self.is_running():
+            return  # Re-entered from a nested Qt event loop, the outer iteration reschedules
+        super().call_soon(self.stop)
+        self.run_forever()
+        self._schedule_next()
+
+    def _schedule_next(self):
+        if not self._inspect:
+            self._wakeup(self.io_poll_interval)
+            return
+        ready: deque = getattr(self, "_ready")
+        scheduled: list = getattr(self, "_scheduled")
+        if ready:
+            self._wakeup(0)
+        elif scheduled:
+            self._wakeup(int(max(0.0, scheduled[0].when() - self.time()) * 1000))
+        if self._has_pending_io():
+            self._wakeup(self.io_poll_interval)
+
+    def _has_pending_io(self):
+        if selector := getattr(self, "_selector", None):
+            return len(selector.get_map()) > 1  # more than the self-pipe
+        if proactor := getattr(self, "_proactor", None):
+            # The proactor loop stops reading its self-pipe when an iteration ends, the cancelled
+            # operation stays in the cache until the next poll
+            return len(proactor._cache) > len(proactor._unregistered)
+        return False
+
+    def _wakeup(self, delay: int):
+        if self.is_closed():
+            return
+        if not self._timer.isActive() or self._timer.remainingTime() > delay:
+            self._timer.start(delay)
+
+    def close(self):
+        self._timer.stop()
+        super().close()
+
+
+_loop = QtEventLoop()
+
+
+def process_python_events():
+    _loop.process_events()
+
+
+def run(future):
+    task = _loop.create_task(future)
     assert task, "Task was not scheduled"
     return task
 
 
+def run_until_complete(future):
+    """Block until `future` is done, for command line tools which don't run a Qt event loop."""
+    return _loop.run_until_complete(future)
+
+
 def stop():
-    global _timer, _loop
     try:
-        _timer.stop()
-        _timer = None
         _loop.stop()
         _loop.close()
     except Exception:
@@ -48,11 +138,17 @@ def stop():
 
 
 async def wait_until(condition: Callable[[], bool], iterations=10, no_error=False):
-    while not condition() and iterations > 0:
-        iterations -= 1
-        if iterations == 0 and not no_error:
-            raise TimeoutError("Timeout while waiting for action to complete")
-        await asyncio.sleep(0.01)
+    # Checks right away and then with growing delays (1ms up to 10ms) until the time budget
+    # of `iterations` * 10ms is used up.
+    deadline = _loop.time() + iterations * 0.01
+    delay = 0.0
+    while not condition():
+        if _loop.time() >= deadline:
+            if not no_error:
+                raise TimeoutError("Timeout while waiting for action to complete")
+            return
+        await asyncio.sleep(delay)
+        delay = min(max(delay * 2, 0.001), 0.01)
 
 
 async def process_events():
@@ -0,0 +1,191 @@
+"""Offload work from the Krita UI thread.
+
+The shared thread pool is meant for work which releases the GIL (Qt image encoding, numpy,
+zlib). The process pool is for pure Python CPU work. It needs a standalone Python interpreter
+matching Krita's, if none is found work submitted to it runs on the thread pool instead.
+Functions sent to the process pool must live in modules which don't import krita or PyQt5.
+
+Futures can be awaited from coroutines running in `eventloop`. Cancelling the awaiting task
+cancels the work if it hasn't started yet.
+"""
+
+from __future__ import annotations
+import asyncio
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, NamedTuple, TypeVar
+
+from . import eventloop
+from .util import is_windows, client_logger as log
+
+T = TypeVar("T")
+
+
+class ExecutorStats(NamedTuple):
+    queued: int  # submitted, not started yet
+    running: int
+    completed: int
+    failed: int
+    cancelled: int
+
+
+class _Pool:
+    """Lazily created executor which keeps queue depth metrics."""
+
+    def __init__(self, name: str, factory: Callable[[], Executor], workers: int, wraps_calls: bool):
+        self.name = name
+        self.workers = workers
+        self._factory = factory
+        self._executor: Executor | None = None
+        self._wraps_calls = wraps_calls  # False for processes, functions must stay picklable
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = 0
+        self._completed = 0
+        self._failed = 0
+        self._cancelled = 0
+
+    def submit(self, fn: Callable[..., T], *args, **kwargs) -> Future[T]:
+        with self._lock:
+            if self._executor is None:
+                self._executor = self._factory()
+            self._pending += 1
+        if self._wraps_calls:
+            future = self._executor.submit(self._call, fn, *args, **kwargs)
+        else:
+            future = self._executor.submit(fn, *args, **kwargs)
+        future.add_done_callback(self._done)
+        return future
+
+    def _call(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        with self._lock:
+            self._running += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    def _done(self, future: Future):
+        with self._lock:
+            self._pending -= 1
+            if future.cancelled():
+                self._cancelled += 1
+            elif future.exception() is not None:
+                self._failed += 1
+            else:
+                self._completed += 1
+
+    @property
+    def stats(self):
+        with self._lock:
+            running = self._running if self._wraps_calls else min(self._pending, self.workers)
+            queued = self._pending - running
+            return ExecutorStats(queued, running, self._completed, self._failed, self._cancelled)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _find_python():
+    """Krita embeds Python, sys.executable is usually Krita itself. Look for an interpreter of
+    the same version inside Krita's Python installation, one found elsewhere may be a different
+    build which can't load the plugin's modules."""
+    prefixes = list(dict.fromkeys(Path(p).resolve() for p in (sys.exec_prefix, sys.base_prefix)))
+    version = f"{sys.version_info.major}.{sys.version_info.minor}"
+    exe = Path(sys.executable)
+    candidates = [exe] if exe.stem.lower().startswith("python") else []
+    for prefix in prefixes:
+        if is_windows:
+            candidates += [prefix / "python.exe", prefix / "bin" / "python.exe"]
+        else:
+            candidates += [prefix / "bin" / f"python{version}"]
+    for candidate in candidates:
+        if candidate.exists() and any(p in candidate.resolve().parents for p in prefixes):
+            return candidate
+    return None
+
+
+_python: Path | None = None
+_python_searched = False
+
+
+def _interpreter():
+    global _python, _python_searched
+    if not _python_searched:
+        _python = _find_python()
+        _python_searched = True
+        if _python is None:
+            log.warning("No Python interpreter found for worker processes, using threads")
+    return _python
+
+
+def _create_process_pool():
+    python = _interpreter()
+    if python is None:
+        return ThreadPoolExecutor(_process_workers, thread_name_prefix="ftm-process-fallback")
+    context = multiprocessing.get_context("spawn")
+    context.set_executable(str(python))
+    log.info(f"Starting process pool with {python}")
+    return ProcessPoolExecutor(max_workers=_process_workers, mp_context=context)
+
+
+_thread_workers = min(32, (os.cpu_count() or 1) + 4)
+_process_workers = max(1, (os.cpu_count() or 2) - 1)
+_threads = _Pool(
+    "threads",
+    lambda: ThreadPoolExecutor(_thread_workers, thread_name_prefix="ftm-worker"),
+    _thread_workers,
+    wraps_calls=True,
+)
+_processes = _Pool("processes", _create_process_pool, _process_workers, wraps_calls=False)
+
+
+def has_process_pool():
+    return _interpreter() is not None
+
+
+def submit(fn: Callable[..., T], *args, **kwargs) -> Future[T]:
+    """Run `fn` on the shared thread pool."""
+    return _threads.submit(fn, *args, **kwargs)
+
+
+def submit_process(fn: Callable[..., T], *args, **kwargs) -> Future[T]:
+    """Run `fn` in a worker process, or on the thread pool if processes are not available."""
+    if has_process_pool():
+        return _processes.submit(fn, *args, **kwargs)
+    return _threads.submit(fn, *args, **kwargs)
+
+
+def wrap(future: Future[T]) -> asyncio.Future[T]:
+    """Make a concurrent future awaitable from the plugin's event loop."""
+    return asyncio.wrap_future(future, loop=eventloop._loop)
+
+
+async def run_in_thread(fn: Callable[..., T], *args, **kwargs) -> T:
+    return await wrap(submit(fn, *args, **kwargs))
+
+
+async def run_in_process(fn: Callable[..., T], *args, **kwargs) -> T:
+    return await wrap(submit_process(fn, *args, **kwargs))
+
+
+def stats() -> dict[str, ExecutorStats]:
+    return {_threads.name: _threads.stats, _processes.name: _processes.stats}
+
+
+def shutdown():
+    _threads.shutdown()
+    _processes.shutdown()
+
+
+def cancel_all(futures: list[Future[Any]]):
+    for future in futures:
+        future.cancel()
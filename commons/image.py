@@ -4,13 +4,16 @@ from math import ceil, sqrt
 from PyQt5.QtGui import QImage, QImageWriter, QPixmap, QIcon, QPainter, QColorSpace
 from PyQt5.QtGui import qRgba, qRed, qGreen, qBlue, qAlpha, qGray
 from PyQt5.QtCore import Qt, QByteArray, QBuffer, QRect, QSize, QFile, QIODevice
-from typing import Callable, Iterable, SupportsIndex, Tuple, NamedTuple, Union, Optional
-from itertools import product
+from typing import Callable, Iterable, SupportsIndex, Tuple, NamedTuple, Union, Optional, TYPE_CHECKING
 from pathlib import Path
 
 from .settings import settings
+from . import executor
 from .util import clamp, ensure, is_linux, client_logger as log
 
+if TYPE_CHECKING:
+    import numpy as np
+
 
 def multiple_of(number, multiple):
     """Round up to the nearest multiple of a number."""
@@ -263,6 +266,26 @@ class Bounds(NamedTuple):
     def from_qrect(qrect: QRect):
         return Bounds(qrect.x(), qrect.y(), qrect.width(), qrect.height())
 
+    @staticmethod
+    def tiles(bounds: "Bounds", tile: Extent, overlap=0):
+        """Split bounds into tiles of (at most) `tile` size, row by row. Neighbouring tiles
+        share `overlap` pixels. Tiles at the right and bottom edge are smaller."""
+        assert tile.width > overlap and tile.height > overlap
+        step_x, step_y = tile.width - overlap, tile.height - overlap
+        end_x, end_y = bounds.x + bounds.width, bounds.y + bounds.height
+        y = bounds.y
+        while y < end_y:
+            height = min(tile.height, end_y - y)
+            x = bounds.x
+            while x < end_x:
+                yield Bounds(x, y, min(tile.width, end_x - x), height)
+                if x + tile.width >= end_x:
+                    break
+                x += step_x
+            if y + tile.height >= end_y:
+                break
+            y += step_y
+
 
 def extent_equal(a: QImage, b: QImage):
     return a.width() == b.width() and a.height() == b.height()
@@ -295,12 +318,33 @@ class ImageFileFormat(Enum):
         return self
 
 
+class ImageDiff(NamedTuple):
+    rmse: float  # root mean square error, normalized to [0, 1]
+    max_abs: int  # largest difference of any channel (0-255)
+    regions: list[Bounds]  # bounding boxes of bands of consecutive changed rows
+
+
 class Image:
 
     _qt_supports_webp = True
+    _buffer: QByteArray | None = None
+    _buffer_key = 0
 
-    def __init__(self, qimage: QImage):
+    def __init__(self, qimage: QImage, buffer: QByteArray | None = None):
         self._qimage = qimage
+        if buffer is not None:
+            # The QImage was created on top of this buffer, as long as it isn't modified or
+            # converted the buffer can be handed out as pixel data without copying
+            self._buffer = buffer
+            self._buffer_key = qimage.cacheKey()
+
+    @staticmethod
+    def from_buffer(data: QByteArray, extent: Extent, format=QImage.Format.Format_ARGB32):
+        """Wrap tightly packed pixel data (eg. from Krita) without copying it."""
+        depth = 1 if format == QImage.Format.Format_Grayscale8 else 4
+        assert data.size() >= extent.pixel_count * depth
+        qimage = QImage(data, extent.width, extent.height, extent.width * depth, format)
+        return Image(qimage, data)
 
     @staticmethod
     def load(filepath: Union[str, Path]):
@@ -408,13 +452,64 @@ class Image:
 
     @staticmethod
     def compare(img_a: "Image", img_b: "Image"):
+        """Root mean square error of all channels, normalized to [0, 1]."""
+        return Image.diff(img_a, img_b).rmse
+
+    @staticmethod
+    def diff(img_a: "Image", img_b: "Image", chunk_rows=256, threshold=0):
+        """Compare two images in chunks of rows using integer arithmetic. Memory use is a few
+        chunks, independent of image size. Pixels where any channel differs by more than
+        `threshold` count as changed."""
         assert extent_equal(img_a._qimage, img_b._qimage)
         import numpy as np
 
-        # Compute RMSE
-        a = img_a.to_array()
-        b = img_b.to_array()
-        return np.sqrt(np.mean((a - b) ** 2))
+        img_a.to_numpy_format()
+        img_b.to_numpy_format()
+        w, h = img_a.extent
+        c = 4 if img_a.is_rgba else 1
+        rows_a, rows_b = img_a._rows(), img_b._rows()
+        sum_sq = 0
+        max_abs = 0
+        regions: list[Bounds] = []
+        band: list[int] | None = None  # [top, bottom, left, right] of the current changed band
+
+        for y0 in range(0, h, chunk_rows):
+            y1 = min(y0 + chunk_rows, h)
+            d = rows_a[y0:y1, : w * c].astype(np.int16)
+            d -= rows_b[y0:y1, : w * c]
+            np.abs(d, out=d)
+            max_abs = max(max_abs, int(d.max(initial=0)))
+            sum_sq += int(np.square(d, dtype=np.int32).sum(dtype=np.int64))
+
+            changed = (d > threshold).reshape(y1 - y0, w, c).any(axis=2)
+            changed_rows = changed.any(axis=1)
+            first = np.argmax(changed, axis=1)
+            last = w - 1 - np.argmax(changed[:, ::-1], axis=1)
+            # Bands of consecutive changed rows: starts where a row changes after an unchanged one
+            padded = np.concatenate(([False], changed_rows, [False]))
+            edges = np.flatnonzero(padded[1:] != padded[:-1])
+            for start, end in zip(edges[::2], edges[1::2]):
+                left, right = int(first[start:end].min()), int(last[start:end].max())
+                if band is not None and band[1] == y0 + start:
+                    band = [band[0], y0 + end, min(band[2], left), max(band[3], right)]
+                else:
+                    if band is not None:
+                        regions.append(Bounds(band[2], band[0], band[3] - band[2] + 1, band[1] - band[0]))
+                    band = [y0 + start, y0 + end, left, right]
+        if band is not None:
+            regions.append(Bounds(band[2], band[0], band[3] - band[2] + 1, band[1] - band[0]))
+
+        count = w * h * c
+        rmse = sqrt(sum_sq / count) / 255 if count > 0 else 0.0
+        return ImageDiff(rmse, max_abs, regions)
+
+    def _rows(self):
+        """View of the image memory as array of shape (height, bytes per line)."""
+        import numpy as np
+
+        bits = ensure(self._qimage.constBits(), "Accessing data of invalid image")
+        bits.setsize(self._qimage.byteCount())
+        return np.frombuffer(bits, np.uint8).reshape(self.height, self._qimage.bytesPerLine())
 
     def pixel(self, x: int, y: int):
         c = self._qimage.pixel(x, y)
@@ -444,18 +539,26 @@ class Image:
         return avg / 255
 
     @property
-    def data(self):
+    def data(self) -> QByteArray | bytes:
+        """Pixel data for Krita. PyQt converts bytes where a QByteArray is expected, so the
+        packed copy is passed on as is."""
         self.to_krita_format()
-        if self._qimage.bytesPerLine() != self._qimage.width() * (self._qimage.depth() // 8):
-            # QImage scanlines are padded to 32-bit, which can be a problem with mask formats
-            buffer = QByteArray()
-            for i in range(self._qimage.height()):
-                ptr = ensure(self._qimage.scanLine(i), "Accessing data of invalid image")
-                buffer.append(ptr.asstring(self._qimage.width() * (self._qimage.depth() // 8)))
-            return buffer
-        else:
-            ptr = ensure(self._qimage.constBits(), "Accessing data of invalid image")
-            return QByteArray(ptr.asstring(self._qimage.byteCount()))
+        if self._buffer is not None and self._qimage.cacheKey() == self._buffer_key:
+            return self._buffer
+        return self.packed_bytes()
+
+    def packed_bytes(self) -> bytes:
+        """Pixel data without scanline padding, copied exactly once."""
+        ptr = ensure(self._qimage.constBits(), "Accessing data of invalid image")
+        ptr.setsize(self._qimage.byteCount())
+        stride = self._qimage.bytesPerLine()
+        row = self._qimage.width() * (self._qimage.depth() // 8)
+        if stride == row:
+            return ptr.asstring()
+        # QImage scanlines are padded to 32-bit, which can be a problem with mask formats.
+        # Join strided views of the rows, this is a single copy without intermediate buffers.
+        view = memoryview(ptr)
+        return b"".join(view[y * stride : y * stride + row] for y in range(self._qimage.height()))
 
     @property
     def size(self):  # in bytes
@@ -474,7 +577,8 @@ class Image:
         return array.astype(np.float32) / 255
 
     def write(self, buffer: QIODevice, format=ImageFileFormat.png):
-        # Compression takes time for large images and blocks the UI, might be worth to thread.
+        # Compression takes time for large images and blocks the UI, use the async variants
+        # (to_bytes_async, save_async) to run it on the thread pool.
         if not self._qt_supports_webp:
             format = format.no_webp_fallback
         format_str, quality = format.value
@@ -488,7 +592,7 @@ class Image:
                     "To enable support for writing webp images, you may need to install the 'qt5-imageformats' package."
                 )
                 Image._qt_supports_webp = False
-                self.write(buffer, format.no_webp_fallback)
+                return self.write(buffer, format.no_webp_fallback)
             raise Exception(f"Failed to write image to buffer: {writer.errorString()} {info}")
 
     def to_bytes(self, format=ImageFileFormat.png):
@@ -499,6 +603,9 @@ class Image:
         buffer.close()
         return byte_array
 
+    async def to_bytes_async(self, format=ImageFileFormat.png):
+        return await executor.run_in_thread(self.to_bytes, format)
+
     def to_base64(self, format=ImageFileFormat.png):
         byte_array = self.to_bytes(format)
         return byte_array.toBase64().data().decode("utf-8")
@@ -533,6 +640,9 @@ class Image:
         finally:
             file.close()
 
+    async def save_async(self, filepath: Union[str, Path]):
+        await executor.run_in_thread(self.save, filepath)
+
     def debug_save(self, name):
         if settings.debug_image_folder:
             self.save(Path(settings.debug_image_folder, f"{name}.png"))
@@ -621,14 +731,24 @@ class ImageCollection:
         return sum(i.size for i in self)
 
     def to_bytes(self, format=ImageFileFormat.webp):
+        return self._assemble([img.to_bytes(format) for img in self])
+
+    async def to_bytes_async(self, format=ImageFileFormat.webp):
+        """Like to_bytes, but images are compressed concurrently on the thread pool (QImageWriter
+        releases the GIL). The result is assembled in input order."""
+        futures = [executor.submit(img.to_bytes, format) for img in self]
+        try:
+            return self._assemble([await executor.wrap(f) for f in futures])
+        finally:
+            executor.cancel_all(futures)
+
+    @staticmethod
+    def _assemble(parts: list[QByteArray]):
         offsets = []
         data = QByteArray()
-        result = QBuffer(data)
-        result.open(QBuffer.OpenModeFlag.WriteOnly)
-        for img in self:
-            offsets.append(result.pos())
-            img.write(result, format)
-        result.close()
+        for part in parts:
+            offsets.append(data.size())
+            data.append(part)
         return data, offsets
 
     @staticmethod
@@ -693,18 +813,19 @@ class Mask:
     @staticmethod
     def rectangle(bounds: Bounds, feather=0):
         # Note: for testing only, where Krita selection is not available
-        m = [255 for i in range(bounds.width * bounds.height)]
-        if feather > 0:
-            for x, y in product(range(bounds.width), range(bounds.height)):
-                l = min(0, x - feather) * -1
-                t = min(0, y - feather) * -1
-                r = max(0, x + feather + 1 - bounds.width)
-                b = max(0, y + feather + 1 - bounds.height)
-                alpha = (
-                    64 * l // feather + 64 * t // feather + 64 * r // feather + 64 * b // feather
-                )
-                m[y * bounds.width + x] = 255 - alpha
-        return Mask(bounds, QByteArray(bytes(m)))
+        if feather <= 0:
+            return Mask(bounds, QByteArray(b"\xff" * (bounds.width * bounds.height)))
+        import numpy as np
+
+        x = np.arange(bounds.width, dtype=np.int32)[np.newaxis, :]
+        y = np.arange(bounds.height, dtype=np.int32)[:, np.newaxis]
+        l = np.maximum(0, feather - x)
+        t = np.maximum(0, feather - y)
+        r = np.maximum(0, x + feather + 1 - bounds.width)
+        b = np.maximum(0, y + feather + 1 - bounds.height)
+        alpha = 64 * l // feather + 64 * t // feather + 64 * r // feather + 64 * b // feather
+        assert alpha.max() <= 255, "Feather too large for mask size"
+        return Mask(bounds, QByteArray((255 - alpha).astype(np.uint8).tobytes()))
 
     @staticmethod
     def load(filepath: Union[str, Path]):
@@ -725,8 +846,22 @@ class Mask:
         return 0
 
     def to_array(self):
-        e = self.bounds.extent
-        return [self.value(x, y) for y in range(e.height) for x in range(e.width)]
+        """Mask values as flat list in row-major order, same values as `value(x, y)`."""
+        import numpy as np
+
+        w, h = self.bounds.extent
+        image = self.image
+        if image.format() != QImage.Format.Format_Grayscale8:
+            image = image.convertToFormat(QImage.Format.Format_ARGB32)
+        bits = ensure(image.constBits(), "Accessing data of invalid image")
+        bits.setsize(image.byteCount())
+        rows = np.frombuffer(bits, np.uint8).reshape(image.height(), image.bytesPerLine())
+        if image.format() == QImage.Format.Format_Grayscale8:
+            return rows[:h, :w].ravel().tolist()
+        # qGray of ARGB32 pixels, stored as BGRA in memory
+        bgra = rows[:h, : w * 4].reshape(h, w, 4).astype(np.uint32)
+        gray = (bgra[..., 2] * 11 + bgra[..., 1] * 16 + bgra[..., 0] * 5) // 32
+        return gray.ravel().tolist()
 
     def to_image(self, extent: Optional[Extent] = None):
         if extent is None:
@@ -736,3 +871,75 @@ class Mask:
         painter = QPainter(img)
         painter.drawImage(self.bounds.x, self.bounds.y, self.image)
         return Image(img)
+
+
+TILE_EXTENT = Extent(1024, 1024)
+
+
+class Tile(NamedTuple):
+    bounds: Bounds  # position of the tile in the image
+    data: "np.ndarray"  # uint8 array of shape (height, width, channels), owned by a TilePool
+
+
+class TilePool:
+    """Bounded pool of tile buffers. Streaming over tiles reuses the same few buffers instead of
+    allocating for each tile, memory stays constant regardless of image size."""
+
+    def __init__(self, capacity=2):
+        self.capacity = capacity
+        self._free: list = []
+
+    def acquire(self, height: int, width: int, channels: int):
+        import numpy as np
+
+        size = height * width * channels
+        for i, buffer in enumerate(self._free):
+            if buffer.size >= size:
+                del self._free[i]
+                return buffer[:size].reshape(height, width, channels)
+        return np.empty(size, np.uint8).reshape(height, width, channels)
+
+    def release(self, tile: "np.ndarray"):
+        buffer = tile.base if tile.base is not None else tile
+        if len(self._free) < self.capacity:
+            self._free.append(buffer.reshape(-1))
+
+
+def content_bounds(values: "np.ndarray", offset: tuple[int, int] = (0, 0)):
+    """Bounding box of the non-zero entries of a 2D array (eg. alpha), zero if there are none."""
+    import numpy as np
+
+    rows = np.flatnonzero(values.any(axis=1))
+    if len(rows) == 0:
+        return Bounds(0, 0, 0, 0)
+    cols = np.flatnonzero(values.any(axis=0))
+    x, y = offset[0] + int(cols[0]), offset[1] + int(rows[0])
+    return Bounds(x, y, int(cols[-1] - cols[0]) + 1, int(rows[-1] - rows[0]) + 1)
+
+
+def read_tiles(
+    read: Callable[[int, int, int, int], QByteArray],
+    bounds: Bounds,
+    channels=4,
+    tile=TILE_EXTENT,
+    overlap=0,
+    pool: TilePool | None = None,
+):
+    """Stream pixel data of `bounds` tile by tile. `read` is a Krita pixel data function like
+    Node.pixelData or Document.pixelData. Each tile's data is only valid until the next tile is
+    requested, copy it if it needs to be kept.
+    """
+    import numpy as np
+
+    pool = pool or TilePool()
+    for tile_bounds in Bounds.tiles(bounds, tile, overlap):
+        shape = (tile_bounds.height, tile_bounds.width, channels)
+        data = read(*tile_bounds)
+        assert data is not None and data.size() >= tile_bounds.area * channels
+        buffer = pool.acquire(*shape)
+        np.copyto(buffer, np.frombuffer(data, np.uint8, count=tile_bounds.area * channels).reshape(shape))
+        del data
+        try:
+            yield Tile(tile_bounds, buffer)
+        finally:
+            pool.release(buffer)
@@ -1,13 +1,19 @@
 from __future__ import annotations
 from contextlib import contextmanager, nullcontext
 from enum import Enum
+import math
+import time
+import zlib
 import krita
-from PyQt5.QtCore import QObject, QUuid, QByteArray, QTimer, pyqtSignal
+from PyQt5.QtCore import QObject, QUuid, QByteArray, pyqtSignal
 from PyQt5.QtGui import QImage
 
-from .image import Extent, Bounds, Image
+from .image import Extent, Bounds, Image, TilePool, TILE_EXTENT, content_bounds, read_tiles
 from .util import ensure, maybe, client_logger as log
-from . import eventloop
+from . import eventloop, scheduler
+
+# Pixel budget of the downscaled copy checksummed by Layer.revision
+_DIGEST_PIXELS = 512 * 512
 
 
 class LayerType(Enum):
@@ -60,14 +66,18 @@ class Layer(QObject):
     _manager: LayerManager
     _node: krita.Node
     _name: str
+    _type_name: str
     _parent: QUuid | None
     _is_confirmed: bool
+    _revision = 0
+    _content_bounds: tuple[tuple[int, int], Bounds] | None = None
 
     def __init__(self, manager: LayerManager, node: krita.Node, is_confirmed=True):
         super().__init__()
         self._manager = manager
         self._node = node
         self._name = node.name()
+        self._type_name = node.type()
         self._parent = maybe(krita.Node.uniqueId, node.parentNode())
         self._is_confirmed = is_confirmed
 
@@ -87,12 +97,13 @@ class Layer(QObject):
     def name(self, value):
         if self._name == value:
             return
-        self._name = value
+        old_name, self._name = self._name, value
         self._node.setName(value)
+        self._manager._renamed(self, old_name)
 
     @property
     def type(self):
-        return LayerType(self._node.type())
+        return LayerType(self._type_name)
 
     @property
     def is_confirmed(self):
@@ -156,7 +167,20 @@ class Layer(QObject):
         else:
             data: QByteArray = self._node.pixelDataAtTime(*bounds, time)
         assert data is not None and data.size() >= bounds.extent.pixel_count * 4
-        return Image(QImage(data, *bounds.extent, QImage.Format.Format_ARGB32))
+        return Image.from_buffer(data, bounds.extent)
+
+    def tiles(
+        self,
+        bounds: Bounds | None = None,
+        tile=TILE_EXTENT,
+        overlap=0,
+        pool: TilePool | None = None,
+    ):
+        """Stream the layer's pixels (alpha for masks) in tiles, see `read_tiles`."""
+        bounds = bounds or self.bounds
+        if self.type.is_mask:
+            return read_tiles(self._node.pixelData, bounds, 1, tile, overlap, pool)
+        return read_tiles(self._node.projectionPixelData, bounds, 4, tile, overlap, pool)
 
     def write_pixels(
         self,
@@ -177,6 +201,7 @@ class Layer(QObject):
             blank = Image.create(layer_bounds.extent, fill=0)
             self._node.setPixelData(blank.data, *layer_bounds)
         self._node.setPixelData(img.data, *bounds)
+        self._revision += 1
         if make_visible:
             self.is_visible = True
         if not silent and self.is_visible:
@@ -190,7 +215,7 @@ class Layer(QObject):
             else:
                 data: QByteArray = self._node.pixelDataAtTime(*bounds, time)
             assert data is not None and data.size() >= bounds.extent.pixel_count
-            return Image(QImage(data, *bounds.extent, QImage.Format.Format_Grayscale8))
+            return Image.from_buffer(data, bounds.extent, QImage.Format.Format_Grayscale8)
         else:
             img = self.get_pixels(bounds, time)
             alpha = img._qimage.convertToFormat(QImage.Format.Format_Alpha8)
@@ -214,7 +239,7 @@ class Layer(QObject):
 
     def remove(self):
         self._node.remove()
-        self._manager.update()
+        self._manager.update(full=True)
 
     def remove_later(self):
         eventloop.run(self._remove_later())
@@ -222,17 +247,43 @@ class Layer(QObject):
     async def _remove_later(self):
         self.remove()
 
+    @property
+    def revision(self):
+        """Changes when the layer's content changes: pixels written through this class, or a
+        different checksum of a downscaled copy (undo, filters, fills, other scripts). The
+        downscaled copy keeps the aspect ratio, thin strips still get enough pixels. Strokes
+        in progress on the active layer may not show up yet (see `is_active_node`)."""
+        bounds = self.bounds
+        scale = min(1.0, math.sqrt(_DIGEST_PIXELS / max(bounds.extent.pixel_count, 1)))
+        thumbnail = self._node.thumbnail(
+            max(1, round(bounds.width * scale)), max(1, round(bounds.height * scale))
+        )
+        digest = 0
+        if not thumbnail.isNull():
+            bits = thumbnail.constBits()
+            bits.setsize(thumbnail.byteCount())
+            digest = zlib.crc32(bits)
+        return (self._revision, digest)
+
     def compute_bounds(self):
         bounds = self.bounds
         if bounds.is_zero:
             return bounds
         if self.type.is_mask:
             # Unfortunately node.bounds() returns the whole image
-            # Use a selection to get just the bounds that contain pixels > 0
-            s = krita.Selection()
-            data = self.node.pixelData(*bounds)
-            s.setPixelData(data, *bounds)
-            return Bounds(s.x(), s.y(), s.width(), s.height())
+            # Scan rows and columns for pixels > 0 tile by tile to get just the bounds of the content
+            self._manager.update()  # notices an active layer switch since the last poll
+            revision = self.revision
+            cached = self._content_bounds
+            if cached is not None and cached[0] == revision and not self._manager.is_active_node(self):
+                return cached[1]
+            result = Bounds(0, 0, 0, 0)
+            for tile in self.tiles(bounds):
+                found = content_bounds(tile.data[..., 0], tile.bounds.offset)
+                if not found.is_zero:
+                    result = found if result.is_zero else Bounds.union(result, found)
+            self._content_bounds = (revision, result)
+            return result
         elif self.type is LayerType.group:
             for child in self.child_layers:
                 if child.type is LayerType.transparency:
@@ -276,7 +327,8 @@ class Layer(QObject):
         self._is_confirmed = True
         changed = False
         if self._name != self._node.name():
-            self._name = self._node.name()
+            old_name, self._name = self._name, self._node.name()
+            self._manager._renamed(self, old_name)
             changed = True
 
         new_parent = maybe(krita.Node.uniqueId, self._node.parentNode())
@@ -326,6 +378,8 @@ class LayerManager(QObject):
     """Periodically checks the document for changes in the layer structure. Krita doesn't expose
     Python events for these kinds of changes, so we have to poll and compare.
     Provides helpers to quickly create new layers and groups with initial content.
+    Layers are indexed by type, name and parent. Queries use the indexes as of the last update
+    and don't touch the Krita layer tree.
     """
 
     changed = pyqtSignal()
@@ -337,22 +391,32 @@ class LayerManager(QObject):
     _layers: dict[QUuid, Layer]
     _active_id: QUuid
     _last_active: Layer | None = None
-    _timer: QTimer
+    _timer: scheduler.PollTask
     _is_updating: bool = False
+    _top_level: dict[QUuid, tuple[str, int]]
+    _active_key: tuple | None = None
+    _subtrees: dict[QUuid, set[QUuid]]
+    _children: dict[QUuid, list[QUuid]]
+    _by_type: dict[str, dict[QUuid, Layer]]
+    _by_name: dict[str, dict[QUuid, Layer]]
+    _last_full_update: float = 0
+    _full_update_interval = 4.0  # seconds
 
     def __init__(self, doc: krita.Document | None):
         super().__init__()
         self._doc = doc
         self._layers = {}
+        self._top_level = {}
+        self._subtrees = {}
+        self._children = {}
+        self._by_type = {}
+        self._by_name = {}
         if doc is not None:
             root = doc.rootNode()
-            self._layers = {root.uniqueId(): Layer(self, root)}
-            self._active_id = doc.activeNode().uniqueId()
-            self.update()
-            self._timer = QTimer()
-            self._timer.setInterval(500)
-            self._timer.timeout.connect(self.update)
-            self._timer.start()
+            self._register(Layer(self, root))
+            self._active_id = maybe(krita.Node.uniqueId, doc.activeNode()) or QUuid()
+            self.update(full=True)
+            self._timer = scheduler.register(self.update, 500, priority=3)
         else:
             self._active_id = QUuid()
 
@@ -368,59 +432,151 @@ class LayerManager(QObject):
         finally:
             self._is_updating = False
 
-    def update(self):
+    def update(self, full=False):
+        """Sync with the document's layer tree. Returns True if anything changed.
+        A cheap fingerprint of the tree (top-level children, their child counts and the active
+        node) decides which top-level subtrees are traversed. Deeper changes which don't show in
+        the fingerprint are picked up by a full traversal every `_full_update_interval` seconds.
+        """
         if self._doc is None:
-            return
+            return False
         if self._is_updating:
-            return
+            return None
         root_node = self._doc.rootNode()
         if root_node is None:
-            return  # Document has been closed
+            self._timer.stop()
+            return False  # Document has been closed
 
-        active = self._doc.activeNode()
-        if active is None:
-            return
+        active = self._doc.activeNode()  # None for documents opened without a view
 
         with self._update_guard():
-            if active.uniqueId() != self._active_id:
+            active_changed = False
+            if active is not None and active.uniqueId() != self._active_id:
+                if previous := self._layers.get(self._active_id):
+                    previous._revision += 1  # may have been painted on while it was active
                 self._active_id = active.uniqueId()
                 self.active_changed.emit()
+                active_changed = True
+
+            top_nodes = {n.uniqueId(): n for n in root_node.childNodes() if _is_real(n)}
+            self._children[root_node.uniqueId()] = list(top_nodes)
+            top_level = {id: (n.name(), len(n.childNodes())) for id, n in top_nodes.items()}
+            active_key = None
+            if active is not None:
+                active_key = (self._active_id, active.name(), maybe(krita.Node.uniqueId, active.parentNode()))
+
+            now = time.monotonic()
+            full = full or now - self._last_full_update >= self._full_update_interval
+            if full:
+                self._last_full_update = now
+                dirty = list(top_nodes)
+            else:
+                dirty = [id for id, key in top_level.items() if self._top_level.get(id) != key]
+                active_moved = active is not None and active_key != self._active_key
+                if active_moved and (top := _top_level_ancestor(active)):
+                    if top.uniqueId() not in dirty and top.uniqueId() in top_nodes:
+                        dirty.append(top.uniqueId())
+            gone = [id for id in self._top_level if id not in top_level]
+            self._top_level = top_level
+            self._active_key = active_key
+            if not dirty and not gone:
+                return active_changed
+
+            if full:
+                candidates = set(self._layers.keys())
+            else:
+                candidates = set()
+                for id in dirty + gone:
+                    candidates |= self._subtrees.get(id, set())
+            for id in gone:
+                self._subtrees.pop(id, None)
 
-            removals = set(self._layers.keys())
             changes = False
-            for n in traverse_layers(root_node):
-                id = n.uniqueId()
-                if id in self._layers:
-                    removals.remove(id)
-                    layer = self._layers[id]
-                    changes = layer.poll() or changes
-                else:
-                    self._layers[id] = Layer(self, n)
-                    changes = True
-
+            visited: set[QUuid] = set()
+            for top_id in dirty:
+                subtree = set()
+                node = top_nodes[top_id]
+                for n in [node, *_collect_layers(node, self._children)]:
+                    id = n.uniqueId()
+                    subtree.add(id)
+                    if id in self._layers:
+                        layer = self._layers[id]
+                        if layer.is_confirmed:
+                            changes = layer.poll() or changes
+                        else:
+                            layer.poll()
+                            self._index(layer)
+                            changes = True
+                    else:
+                        self._register(Layer(self, n))
+                        changes = True
+                self._subtrees[top_id] = subtree
+                visited |= subtree
+
+            removals = candidates - visited
             removals.discard(root_node.uniqueId())
             for id in removals:
-                if self._layers[id].is_confirmed:
+                if id in self._layers and self._layers[id].is_confirmed:
                     self.removed.emit(self._layers[id])
-                    del self._layers[id]
+                    self._unregister(id)
 
             if removals or changes:
                 self.changed.emit()
+            return bool(removals) or changes or active_changed
 
     def wrap(self, node: krita.Node) -> Layer:
         layer = self.find(node.uniqueId())
         if layer is None:
             layer = Layer(self, node, is_confirmed=False)
-            self._layers[node.uniqueId()] = layer
+            self._register(layer)
         return layer
 
+    def _register(self, layer: Layer):
+        self._layers[layer.id] = layer
+        # Layers created by wrap() are indexed once a traversal has seen them
+        if layer.is_confirmed:
+            self._index(layer)
+
+    def _index(self, layer: Layer):
+        self._by_type.setdefault(layer._type_name, {})[layer.id] = layer
+        self._by_name.setdefault(layer.name, {})[layer.id] = layer
+
+    def _unregister(self, id: QUuid):
+        layer = self._layers.pop(id)
+        self._by_type.get(layer._type_name, {}).pop(id, None)
+        self._by_name.get(layer.name, {}).pop(id, None)
+        self._children.pop(id, None)
+
+    def _renamed(self, layer: Layer, old_name: str):
+        if self._layers.get(layer.id) is not layer or not layer.is_confirmed:
+            return
+        self._by_name.get(old_name, {}).pop(layer.id, None)
+        self._by_name.setdefault(layer.name, {})[layer.id] = layer
+
+    def of_type(self, *types: LayerType) -> list[Layer]:
+        return [l for t in types for l in self._by_type.get(t.value, {}).values()]
+
+    def find_by_name(
+        self, name: str, type: LayerType | None = None, parent: Layer | None = None
+    ) -> list[Layer]:
+        result = self._by_name.get(name, {}).values()
+        if type is not None:
+            result = (l for l in result if l._type_name == type.value)
+        if parent is not None:
+            result = (l for l in result if l._parent == parent.id)
+        return list(result)
+
+    def children_of(self, layer: Layer) -> list[Layer]:
+        ids = self._children.get(layer.id, [])
+        return [self._layers[id] for id in ids if id in self._layers]
+
     def find(self, id: QUuid) -> Layer | None:
         if self._doc is None:
             return None
         return self._layers.get(id)
 
-    def updated(self):
-        self.update()
+    def updated(self, full=False):
+        self.update(full)
         return self
 
     @property
@@ -429,6 +585,11 @@ class LayerManager(QObject):
         root = ensure(self._doc.rootNode(), "Document root node was None")
         return self.wrap(root)
 
+    def is_active_node(self, layer: Layer):
+        """Cheap check against Krita's active node, without updating the layer tree."""
+        active = self._doc.activeNode() if self._doc is not None else None
+        return active is not None and active.uniqueId() == layer.id
+
     @property
     def active(self):
         try:
@@ -481,14 +642,14 @@ class LayerManager(QObject):
         parent = parent or self.root
         with RestoreActiveLayer(self) if not make_active else nullcontext():
             parent.node.addChildNode(node, above.node if above else None)
-            return self.updated().wrap(node)
+            return self.updated(full=True).wrap(node)
 
     def create_vector(self, name: str, svg: str):
         doc = ensure(self._doc)
         node = doc.createVectorLayer(name)
         doc.rootNode().addChildNode(node, None)
         node.addShapesFromSvg(svg)
-        layer = self.updated().wrap(node)
+        layer = self.updated(full=True).wrap(node)
         layer.refresh()
         return layer
 
@@ -524,26 +685,39 @@ class LayerManager(QObject):
         layer.remove_later()
         return replacement
 
-    _image_types = [t.value for t in LayerType if t.is_image]
-    _mask_types = [t.value for t in LayerType if t.is_mask]
+    _image_types = [t for t in LayerType if t.is_image]
+    _mask_types = [t for t in LayerType if t.is_mask]
 
     @property
     def all(self):
+        """All layers in tree order (depth-first, bottom to top)."""
         if self._doc is None:
             return []
-        return [self.wrap(n) for n in traverse_layers(self._doc.rootNode())]
+        result: list[Layer] = []
+        stack = list(reversed(self._children.get(self._doc.rootNode().uniqueId(), [])))
+        while stack:
+            id = stack.pop()
+            if layer := self._layers.get(id):
+                result.append(layer)
+                stack.extend(reversed(self._children.get(id, [])))
+        return result
 
     @property
     def images(self):
         if self._doc is None:
             return []
-        return [self.wrap(n) for n in traverse_layers(self._doc.rootNode(), self._image_types)]
+        return self._all_of_type(self._image_types)
 
     @property
     def masks(self):
         if self._doc is None:
             return []
-        return [self.wrap(n) for n in traverse_layers(self._doc.rootNode(), self._mask_types)]
+        return self._all_of_type(self._mask_types)
+
+    def _all_of_type(self, types: list[LayerType]):
+        # In tree order like `all`, of_type groups layers by type
+        names = {t.value for t in types}
+        return [l for l in self.all if l._type_name in names]
 
     @property
     def image_extent(self):
@@ -563,6 +737,24 @@ def traverse_layers(node: krita.Node, type_filter: list[str] | None = None):
         yield from traverse_layers(child, type_filter)
 
 
+def _collect_layers(node: krita.Node, children: dict[QUuid, list[QUuid]]):
+    """Same as traverse_layers, but records the real child ids of every visited node."""
+    ids = []
+    for child in node.childNodes():
+        if _is_real(child):
+            ids.append(child.uniqueId())
+            yield child
+        yield from _collect_layers(child, children)
+    children[node.uniqueId()] = ids
+
+
+def _top_level_ancestor(node: krita.Node):
+    parent = node.parentNode()
+    while parent is not None and parent.parentNode() is not None:
+        node, parent = parent, parent.parentNode()
+    return node if parent is not None else None
+
+
 def _is_real(node_type: krita.Node | str):
     # Krita sometimes inserts "fake" nodes for processing, like decorations-wrapper-layer
     # They don't have a layer type and we want to ignore them
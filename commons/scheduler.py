@@ -0,0 +1,166 @@
+from __future__ import annotations
+import inspect
+import time
+import weakref
+from typing import Callable
+from PyQt5.QtCore import QObject, QEvent, QTimer
+from PyQt5.QtWidgets import QApplication
+
+from .util import client_logger as log
+
+# Poll callbacks return False if nothing changed, which doubles their interval up to a limit.
+# True (or None) keeps polling at the base interval.
+PollCallback = Callable[[], "bool | None"]
+
+_activity_events = {
+    QEvent.Type.MouseButtonPress,
+    QEvent.Type.MouseButtonRelease,
+    QEvent.Type.KeyPress,
+    QEvent.Type.KeyRelease,
+    QEvent.Type.Wheel,
+    QEvent.Type.TabletPress,
+    QEvent.Type.TabletRelease,
+}
+
+
+def _now():
+    return time.monotonic() * 1000
+
+
+class PollTask:
+    """A callback registered with the PollScheduler. Bound methods are referenced weakly,
+    the task stops by itself when its owner is garbage collected."""
+
+    name: str
+    priority: int
+    base_interval: int
+    max_interval: int
+    interval: int
+    due: float
+
+    def __init__(self, callback: PollCallback, interval: int, priority: int, max_interval: int):
+        if inspect.ismethod(callback):
+            self._callback = weakref.WeakMethod(callback)
+        else:
+            self._callback = lambda: callback
+        self.name = getattr(callback, "__qualname__", repr(callback))
+        self.priority = priority
+        self.base_interval = interval
+        self.max_interval = max(max_interval, interval)
+        self.interval = interval
+        self.due = _now() + interval
+        self._stopped = False
+
+    @property
+    def is_active(self):
+        return not self._stopped and self._callback() is not None
+
+    def stop(self):
+        self._stopped = True
+
+    def reset(self, now: float):
+        self.interval = self.base_interval
+        self.due = min(self.due, now + self.interval)
+
+    def wake(self):
+        """Run as soon as possible at the base interval, for changes made without user input."""
+        now = _now()
+        self.interval = self.base_interval
+        self.due = now
+        PollScheduler.instance()._schedule()
+
+    def run(self, now: float):
+        callback = self._callback()
+        if callback is None:
+            self._stopped = True
+            return
+        try:
+            changed = callback()
+        except Exception as e:
+            log.exception(f"Poll task {self.name} failed: {e}")
+            changed = None
+        if changed is False:
+            self.interval = min(self.interval * 2, self.max_interval)
+        else:
+            self.interval = self.base_interval
+        self.due = now + self.interval
+
+
+class PollScheduler(QObject):
+    """Runs all periodic polling of the plugin from a single timer. The timer only wakes up
+    when the next task is due. Tasks which report no changes back off exponentially, user
+    input snaps all tasks back to their base interval.
+    """
+
+    _instance: PollScheduler | None = None
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    _tasks: list[PollTask]
+    _timer: QTimer
+    _last_activity: float = 0
+
+    def __init__(self):
+        super().__init__()
+        self._tasks = []
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._run)
+        if app := QApplication.instance():
+            app.installEventFilter(self)
+
+    def register(
+        self,
+        callback: PollCallback,
+        interval: int,
+        priority: int = 0,
+        max_interval: int | None = None,
+    ):
+        """Poll `callback` every `interval` milliseconds, backing off up to `max_interval`
+        (default 16x interval). Tasks with higher priority run first when due together."""
+        task = PollTask(callback, interval, priority, max_interval or interval * 16)
+        self._tasks.append(task)
+        self._schedule()
+        return task
+
+    def poke(self):
+        """Reset all tasks to their base interval, eg. because of user activity."""
+        now = _now()
+        self._last_activity = now
+        for task in self._tasks:
+            task.reset(now)
+        self._schedule()
+
+    def eventFilter(self, obj, event):
+        # Input events arrive in bursts and for every widget along the way, handle them sparingly
+        if event.type() in _activity_events and _now() - self._last_activity > 50:
+            self.poke()
+        return False
+
+    def _run(self):
+        now = _now()
+        self._tasks = [t for t in self._tasks if t.is_active]
+        due = sorted((t for t in self._tasks if t.due <= now), key=lambda t: -t.priority)
+        for task in due:
+            if task.is_active:
+                task.run(now)
+        self._schedule()
+
+    def _schedule(self):
+        active = [t.due for t in self._tasks if t.is_active]
+        if not active:
+            self._timer.stop()
+            return
+        delay = max(0, int(min(active) - _now()))
+        if not self._timer.isActive() or self._timer.remainingTime() > delay:
+            self._timer.start(delay)
+
+
+def register(
+    callback: PollCallback, interval: int, priority: int = 0, max_interval: int | None = None
+):
+    return PollScheduler.instance().register(callback, interval, priority, max_interval)
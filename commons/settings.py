@@ -138,6 +138,46 @@ class Settings(QObject):
         "History Size", 1000, "Main memory (RAM) used to keep the history of generated images"
     )
 
+    document_memory_budget: int
+    _document_memory_budget = Setting(
+        "Document Memory Budget",
+        4096,
+        "Main memory (RAM, in MB) used by project pages which are kept open in the background",
+    )
+
+    ocr_command: str
+    _ocr_command = Setting(
+        "OCR Command",
+        "",
+        "Command line of a local OCR program. It reads a JSON list of base64 PNG images from stdin"
+        " and writes a JSON list of texts to stdout.",
+    )
+
+    ocr_url: str
+    _ocr_url = Setting(
+        "OCR Server URL",
+        "",
+        "URL of a local OCR server which accepts the same JSON lists via POST."
+        " Used instead of the OCR command if set.",
+    )
+
+    translation_url: str
+    _translation_url = Setting(
+        "Translation Server URL",
+        "",
+        "URL of a machine translation server used to pre-translate source texts",
+    )
+
+    translation_source_language: str
+    _translation_source_language = Setting(
+        "Translation Source Language", "ja", "Language code of the source texts"
+    )
+
+    translation_target_language: str
+    _translation_target_language = Setting(
+        "Translation Target Language", "en", "Language code to translate into"
+    )
+
     performance_preset: PerformancePreset
     _performance_preset = Setting(
         "Performance Preset",
@@ -192,6 +192,7 @@ async def create_process(
     cwd: Path | None = None,
     additional_env: dict | None = None,
     pipe_stderr=False,
+    pipe_stdin=False,
 ):
     platform_args = {}
     if is_windows:
@@ -207,9 +208,10 @@ async def create_process(
 
     out = asyncio.subprocess.PIPE
     err = asyncio.subprocess.PIPE if pipe_stderr else asyncio.subprocess.STDOUT
+    inp = asyncio.subprocess.PIPE if pipe_stdin else None
 
     p = await asyncio.create_subprocess_exec(
-        program, *args, cwd=cwd, stdout=out, stderr=err, env=env, **platform_args
+        program, *args, cwd=cwd, stdin=inp, stdout=out, stderr=err, env=env, **platform_args
     )
     if is_windows:
         try:
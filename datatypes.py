@@ -1,41 +1,88 @@
-import copy
-from dataclasses import dataclass
 import json
+import os
 from pathlib import Path
-from typing import Union
+from typing import Optional, Union
 
 '''
 og: original
 fn: filename
 '''
 
-@dataclass
 class Page:
-    uid:str
-    og_fn:str
-    kra_fn:Path
-    def toJSON(self,root:Path):
-        return {"uid":self.uid,"og_fn":str(self.og_fn),"kra_fn":str(self.kra_fn.relative_to(root))}
-    
+    '''
+    A single page of a project. Only strings relative to the project root are kept,
+    paths are materialized on first access. Projects can hold many thousands of pages.
+    '''
+    __slots__ = ("uid","og_fn","kra_rel","root","_kra_fn")
+
+    def __init__(self,uid:str,og_fn:str,kra_rel:str,root:Path):
+        self.uid=uid
+        self.og_fn=og_fn
+        self.kra_rel=kra_rel
+        self.root=root
+        self._kra_fn:Optional[Path]=None
+
+    @property
+    def kra_fn(self) -> Path:
+        if self._kra_fn is None:
+            self._kra_fn = self.root/self.kra_rel
+        return self._kra_fn
+
+    @property
+    def thm_fn(self) -> Path:
+        return self.root/THM_FOLDER/(self.uid+".jpg")
+
+    def toJSON(self):
+        return {"uid":self.uid,"og_fn":self.og_fn,"kra_fn":self.kra_rel}
+
     @classmethod
     def fromJSON(cls,dic:dict,root:Path):
-        return cls(uid=dic["uid"],
-                    og_fn=root/dic["og_fn"],
-                    kra_fn=root/dic["kra_fn"])
+        return cls(dic["uid"],dic["og_fn"],dic["kra_fn"],root)
+
+    def __eq__(self,other):
+        if not isinstance(other,Page):
+            return NotImplemented
+        return self.uid == other.uid and self.kra_rel == other.kra_rel and self.root == other.root
+
+    def __hash__(self):
+        return hash(self.uid)
+
+    def __repr__(self):
+        return f"Page(uid={self.uid!r}, og_fn={self.og_fn!r}, kra_fn={self.kra_rel!r})"
 
 KRA_FOLDER = "kras"
 THM_FOLDER = "thms"
 THM_RECT = 256
+# Layer holding the original art of a page
+ORIG_LAYER_NAME = "Background"
+PROJECT_FN = "project.json"
+JOURNAL_FN = "project.journal"
+# Number of journal entries after which save() folds the journal into a new snapshot
+JOURNAL_COMPACT_LIMIT = 256
+
+def _write_synced(path:Path,text:str,mode:str="w"):
+    with open(path,mode,encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
 
 class Project:
-    title: str
-    pages: list[Page]
+    '''
+    The project is stored as a snapshot (project.json) plus an append-only journal
+    (project.journal) of changes made since the snapshot was written.
+    Changes are recorded as they happen and save() only appends the pending ones.
+    '''
     root_path: Path
+    _pages: list[Page]
+    _uid_set: set[str]
 
     def __init__(self,root_path:Path) -> None:
         self.root_path=Path(root_path)
-        self.pages=[]
-        self.title = ""
+        self._pages=[]
+        self._uid_set=set()
+        self._title = ""
+        self._pending:list[dict] = []
+        self._journal_len = 0
         kras_folder = self.root_path / KRA_FOLDER
         kras_folder.mkdir(parents=True, exist_ok=True)
         thms_folder = self.root_path / THM_FOLDER
@@ -45,29 +92,107 @@ class Project:
     def load(cls,path:Path):
         meta=json.loads(path.read_bytes())
         new_inst = cls((path.parent/meta["root_path"]).absolute().resolve())
-        new_inst.pages=[Page.fromJSON(x,new_inst.root_path) for x in meta["pages"]]
-        new_inst.title=meta["title"]
+        new_inst._set_pages([Page.fromJSON(x,new_inst.root_path) for x in meta["pages"]])
+        new_inst._title=meta["title"]
+        new_inst._replay(path.parent/JOURNAL_FN)
         return new_inst
     
+    def _replay(self,journal:Path):
+        if not journal.exists():
+            return
+        for line in journal.read_text(encoding="utf-8").splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break  # Torn write from a crash, everything after it is lost anyway
+            self._apply(entry)
+            self._journal_len += 1
+
+    def _apply(self,entry:dict):
+        # Entries must be idempotent: a crash between writing a snapshot and removing
+        # the journal replays entries which are already part of the snapshot.
+        op = entry["op"]
+        if op == "add":
+            page = Page.fromJSON(entry["page"],self.root_path)
+            if page.uid not in self._uid_set:
+                self._append(page)
+        elif op == "order":
+            by_uid = {x.uid:x for x in self._pages}
+            ordered = [by_uid.pop(uid) for uid in entry["uids"] if uid in by_uid]
+            self._pages = ordered + list(by_uid.values())
+        elif op == "title":
+            self._title = entry["title"]
+        elif op == "rename":
+            page = Page.fromJSON(entry["page"],self.root_path)
+            for i,x in enumerate(self._pages):
+                if x.uid == entry["uid"]:
+                    self._pages[i] = page
+                    self._uid_set.discard(x.uid)
+                    self._uid_set.add(page.uid)
+                    break
+
+    def _set_pages(self,pages:list[Page]):
+        self._pages = pages
+        self._uid_set = {x.uid for x in pages}
+
+    def _append(self,page:Page):
+        self._pages.append(page)
+        self._uid_set.add(page.uid)
+
+    def _record(self,entry:dict):
+        self._pending.append(entry)
+
+    @property
+    def title(self):
+        return self._title
+
+    @title.setter
+    def title(self,value:str):
+        if value != self._title:
+            self._title = value
+            self._record({"op":"title","title":value})
+
+    @property
+    def pages(self) -> list[Page]:
+        # Read-only view by convention, use add_page/reorder to modify
+        return self._pages
+
     @property
     def uids(self):
-        return [x.uid for x in self.pages]
+        return [x.uid for x in self._pages]
     
     @property
     def thms(self):
-        return [self.root_path/THM_FOLDER/(x.uid+".jpg") for x in self.pages]
+        return [x.thm_fn for x in self._pages]
     
-    def add_page(self,krita_inst,file_path:Union[Path,str]):
+    def has_uid(self,uid:str):
+        return uid in self._uid_set
+
+    def page_index(self,kra_fn:Path) -> Optional[int]:
+        # Page .kra files are named after their uid, skip the scan for foreign documents
+        if kra_fn.stem not in self._uid_set:
+            return None
+        for i,page in enumerate(self._pages):
+            if page.kra_fn == kra_fn:
+                return i
+        return None
+
+    def add_page(self,krita_inst,file_path:Union[Path,str],doc=None):
+        '''
+        Import an image file as a new page. If the image was already loaded into a document
+        (eg. decoded from an archive), pass it as `doc`; `file_path` then only names the page.
+        '''
         file_path = Path(file_path)
         uid = file_path.stem
-        uids = set(self.uids)
-        while uid in uids:
+        while uid in self._uid_set:
             uid+="_"
 
-        kra_path = self.root_path / KRA_FOLDER / (uid + ".kra")
-        thm_path = self.root_path / THM_FOLDER / (uid + ".jpg")
+        page = Page(uid,file_path.name,f"{KRA_FOLDER}/{uid}.kra",self.root_path)
+        kra_path = page.kra_fn
+        thm_path = page.thm_fn
         
-        doc = krita_inst.openDocument(str(file_path))
+        if doc is None:
+            doc = krita_inst.openDocument(str(file_path))
         
         # Save .kra
         doc.setBatchmode(True)
@@ -80,13 +205,136 @@ class Project:
         doc.thumbnail(rw,rh).save(str(thm_path))
         doc.close()
 
-        self.pages.append(Page(uid,file_path.name,kra_path))
+        self._append(page)
+        self._record({"op":"add","page":page.toJSON()})
+
+    def rename_page(self,page:Page,og_fn:str):
+        '''
+        Change the name a page is shown with. The uid stays, it names the page's files and
+        identifies the page elsewhere (exports, translation pairs).
+        '''
+        if og_fn == page.og_fn:
+            return
+        page.og_fn = og_fn
+        self._record({"op":"rename","uid":page.uid,"page":page.toJSON()})
+
+    def reorder(self,pages:list[Page]):
+        pages = list(pages)
+        if len(pages) != len(self._pages) or {x.uid for x in pages} != self._uid_set:
+            raise ValueError("reorder must keep the same pages")
+        self._pages = pages
+        self._record({"op":"order","uids":self.uids})
 
     def save(self):
-        jsons=copy.deepcopy(vars(self))
-        jsons["root_path"] = "."
-        jsons["pages"] = [x.toJSON(self.root_path) for x in jsons["pages"]]
-        (self.root_path/"project.json").write_text(json.dumps(jsons,ensure_ascii=False))
+        if not (self.root_path/PROJECT_FN).exists() or self._journal_len + len(self._pending) > JOURNAL_COMPACT_LIMIT:
+            self.compact()
+            return
+        if not self._pending:
+            return
+        lines = "".join(json.dumps(x,ensure_ascii=False)+"\n" for x in self._pending)
+        _write_synced(self.root_path/JOURNAL_FN,lines,"a")
+        self._journal_len += len(self._pending)
+        self._pending.clear()
 
+    def compact(self):
+        '''Write a full snapshot atomically and drop the journal.'''
+        jsons = {
+            "title":self._title,
+            "pages":[x.toJSON() for x in self._pages],
+            "root_path":".",
+        }
+        snapshot = self.root_path/PROJECT_FN
+        tmp = snapshot.with_name(PROJECT_FN+".tmp")
+        _write_synced(tmp,json.dumps(jsons,ensure_ascii=False))
+        os.replace(tmp,snapshot)
+        (self.root_path/JOURNAL_FN).unlink(missing_ok=True)
+        self._journal_len = 0
+        self._pending.clear()
 
-        
+SERIES_FN = "series.json"
+
+class Chapter:
+    '''Entry of a series manifest. The chapter's project is only loaded when first accessed.'''
+    __slots__ = ("title","rel_path","root","_project")
+
+    def __init__(self,title:str,rel_path:str,root:Path):
+        self.title=title
+        self.rel_path=rel_path
+        self.root=root
+        self._project:Optional[Project]=None
+
+    @property
+    def path(self) -> Path:
+        return self.root/self.rel_path
+
+    @property
+    def is_loaded(self):
+        return self._project is not None
+
+    @property
+    def project(self) -> Project:
+        if self._project is None:
+            self._project = Project.load(self.path/PROJECT_FN)
+        return self._project
+
+    def toJSON(self):
+        return {"title":self.title,"path":self.rel_path}
+
+    @classmethod
+    def fromJSON(cls,dic:dict,root:Path):
+        return cls(dic["title"],dic["path"],root)
+
+class Series:
+    '''
+    A series groups chapter projects which live in sub folders next to series.json:
+    series.json, ch01/project.json, ch02/project.json, ...
+    '''
+    title: str
+    root_path: Path
+    chapters: list[Chapter]
+
+    def __init__(self,root_path:Path,title:str="") -> None:
+        # Resolved, chapter paths are stored relative to it
+        self.root_path=Path(root_path).absolute().resolve()
+        self.title=title or self.root_path.name
+        self.chapters=[]
+
+    @classmethod
+    def load(cls,path:Path):
+        meta=json.loads(path.read_bytes())
+        new_inst = cls(path.parent.absolute().resolve(),meta["title"])
+        new_inst.chapters=[Chapter.fromJSON(x,new_inst.root_path) for x in meta["chapters"]]
+        return new_inst
+
+    @classmethod
+    def load_or_create(cls,root_path:Path):
+        path = Path(root_path)/SERIES_FN
+        return cls.load(path) if path.exists() else cls(root_path)
+
+    @staticmethod
+    def find_for(project_root:Path) -> Optional[Path]:
+        path = Path(project_root).parent/SERIES_FN
+        return path if path.exists() else None
+
+    def chapter_for(self,project_root:Path) -> Optional[Chapter]:
+        project_root = Path(project_root).absolute().resolve()
+        for chapter in self.chapters:
+            if chapter.path.absolute().resolve() == project_root:
+                return chapter
+        return None
+
+    def add_chapter(self,project_root:Path,title:str) -> Chapter:
+        rel_path = Path(project_root).absolute().resolve().relative_to(self.root_path.resolve()).as_posix()
+        chapter = self.chapter_for(project_root)
+        if chapter is None:
+            chapter = Chapter(title,rel_path,self.root_path)
+            self.chapters.append(chapter)
+        chapter.title = title
+        return chapter
+
+    def save(self):
+        jsons = {"title":self.title,"chapters":[x.toJSON() for x in self.chapters]}
+        manifest = self.root_path/SERIES_FN
+        tmp = manifest.with_name(SERIES_FN+".tmp")
+        _write_synced(tmp,json.dumps(jsons,ensure_ascii=False))
+        os.replace(tmp,manifest)
@@ -0,0 +1,103 @@
+from collections import OrderedDict
+from pathlib import Path
+from krita import Krita, Document, Node
+from PyQt5.QtCore import QObject
+from .datatypes import Page
+from .project_watcher import ProjectWatcher
+from .commons.settings import settings
+from .commons.util import client_logger as log
+
+_channel_count = {"A": 1, "GRAYA": 2, "RGBA": 4, "XYZA": 4, "LABA": 4, "CMYKA": 5, "YCbCrA": 4}
+_channel_size = {"U8": 1, "U16": 2, "F16": 2, "F32": 4}
+
+
+def estimate_memory(doc: Document):
+    """Rough size of a document in bytes: extent x layers x pixel size."""
+    pixel_size = _channel_count.get(doc.colorModel(), 4) * _channel_size.get(doc.colorDepth(), 1)
+    layers = _count_nodes(doc.rootNode()) + 1  # +1 for the projection
+    return doc.width() * doc.height() * layers * pixel_size
+
+
+def _count_nodes(node: Node) -> int:
+    return sum(1 + _count_nodes(child) for child in node.childNodes())
+
+
+def _shown_files():
+    """Files of all documents which have a view in any window, including the active one."""
+    shown = set()
+    for window in Krita.instance().windows():
+        shown.update(Path(view.document().fileName()) for view in window.views())
+    active = Krita.instance().activeDocument()
+    if active is not None:
+        shown.add(Path(active.fileName()))
+    return shown
+
+
+class DocumentSession(QObject):
+    """Keeps track of project pages opened through the dockers. When their estimated memory
+    exceeds the configured budget, the least recently used pages without unsaved changes are
+    closed. Modified pages and pages shown in a view are never closed.
+    """
+    __instance = None
+    @classmethod
+    def instance(cls):
+        if cls.__instance is None:
+            cls.__instance=cls()
+        return cls.__instance
+
+    _docs: "OrderedDict[Path, Document]"
+    _sizes: dict[Path, int]
+
+    def __init__(self):
+        super().__init__()
+        self._docs = OrderedDict()
+        self._sizes = {}
+        self._warned: set[Path] = set()
+        ProjectWatcher.instance().page_changed.connect(self.pageChanged)
+
+    @property
+    def budget(self):
+        return settings.document_memory_budget * 1024 * 1024
+
+    @property
+    def used(self):
+        return sum(self._sizes.values())
+
+    def track(self, doc: Document):
+        kra_fn = Path(doc.fileName())
+        self._docs[kra_fn] = doc
+        self._docs.move_to_end(kra_fn)
+        self._sizes[kra_fn] = estimate_memory(doc)
+        self.enforce()
+
+    def pageChanged(self, page: Page, index: int):
+        for doc in Krita.instance().documents():
+            if Path(doc.fileName()) == page.kra_fn:
+                self.track(doc)
+                return
+
+    def enforce(self):
+        open_docs = Krita.instance().documents()
+        for kra_fn in [k for k, doc in self._docs.items() if doc not in open_docs]:
+            self._forget(kra_fn)
+
+        shown = _shown_files()
+        for kra_fn in list(self._docs):  # least recently used first
+            if self.used <= self.budget:
+                return
+            doc = self._docs[kra_fn]
+            if kra_fn in shown:
+                continue  # active, or in another tab or window
+            if doc.modified():
+                if kra_fn not in self._warned:
+                    log.warning(f"Memory budget exceeded, but {kra_fn.name} has unsaved changes")
+                    self._warned.add(kra_fn)
+                continue
+            log.info(f"Closing {kra_fn.name} to stay within the document memory budget")
+            self._forget(kra_fn)
+            doc.close()
+
+    def _forget(self, kra_fn: Path):
+        self._docs.pop(kra_fn, None)
+        self._sizes.pop(kra_fn, None)
+        self._warned.discard(kra_fn)
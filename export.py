@@ -0,0 +1,451 @@
+"""Export the pages of a chapter to image files.
+
+Pages are read from the `mergedimage.png` Krita stores inside every .kra file, so documents
+don't have to be opened. Decoding, resizing and encoding run on the thread pool (Qt's image
+codecs release the GIL). Files are written under a temporary name and renamed when complete.
+
+A manifest in the output folder records which .kra version and options each file was exported
+from, so exporting again only redoes pages which changed. Files are named after the page order,
+when pages were reordered the existing files are renamed.
+
+Chapters can also be bundled into a single CBZ or PDF file. Pages are rendered a few ahead of
+the writer on the thread pool and appended in order as they finish, so memory use doesn't
+depend on the length of the chapter.
+
+Runs without Krita too (PyQt5 is required):
+
+    python -m <plugin package>.export <project folder> <output folder> --format webp
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import struct
+import zipfile
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Callable, NamedTuple, Optional
+from PyQt5.QtCore import QCoreApplication, QMarginsF, QRectF, QSizeF
+from PyQt5.QtGui import QGuiApplication, QPageSize, QPainter, QPdfWriter
+
+from .commons.image import Extent, Image, ImageFileFormat
+from .commons.util import ZipFile, client_logger as log
+from .commons import eventloop, executor
+from .datatypes import Page, Project, PROJECT_FN
+
+EXPORT_FORMATS = {
+    "png": ImageFileFormat.png,
+    "webp": ImageFileFormat.webp,
+    "jpeg": ImageFileFormat.jpeg,
+}
+BUNDLE_FORMATS = ("cbz", "pdf")
+# Pages rendered ahead of the bundle writer, bounds the memory used by bundle export
+BUNDLE_WINDOW = 4
+
+
+class ExportOptions(NamedTuple):
+    format: str = "png"  # key of EXPORT_FORMATS
+    max_width: int = 0  # pages wider than this are scaled down, 0 keeps the original size
+
+    @property
+    def extension(self):
+        return "jpg" if self.format == "jpeg" else self.format
+
+    @property
+    def key(self):
+        return hashlib.sha256(json.dumps(self._asdict(), sort_keys=True).encode()).hexdigest()[:16]
+
+
+MANIFEST_FN = ".export_manifest.json"
+
+
+def page_filename(index: int, options: ExportOptions):
+    return f"{index + 1:03d}.{options.extension}"
+
+
+class ExportManifest:
+    """Maps page uid to the exported file, the .kra (mtime, size) it was exported from and the
+    key of the export options."""
+
+    def __init__(self, folder: Path, entries: Optional[dict[str, dict]] = None):
+        self.folder = folder
+        self.entries = entries or {}
+
+    @classmethod
+    def load(cls, folder: Path):
+        try:
+            data = json.loads((folder / MANIFEST_FN).read_bytes())
+            return cls(folder, data["pages"])
+        except (OSError, ValueError, KeyError):
+            return cls(folder)
+
+    def save(self):
+        data = json.dumps({"pages": self.entries}, ensure_ascii=False, indent=1)
+        write_atomic(self.folder / MANIFEST_FN, data.encode())
+
+    @staticmethod
+    def source_stamp(kra_fn: Path):
+        stat = kra_fn.stat()
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def is_current(self, page: Page, options: ExportOptions):
+        entry = self.entries.get(page.uid)
+        return (
+            entry is not None
+            and entry["options"] == options.key
+            and entry["source"] == self.source_stamp(page.kra_fn)
+            and (self.folder / entry["file"]).exists()
+        )
+
+    def record(self, page: Page, file: str, options: ExportOptions, source: Optional[list[int]]):
+        self.entries[page.uid] = {"file": file, "source": source, "options": options.key}
+
+    def rename_files(self, pages: list[Page], outdated: set[str], options: ExportOptions):
+        """Rename the files of pages whose position changed. Pages in `outdated` are about to be
+        exported again, their old files are removed instead."""
+        moves = []
+        for i, page in enumerate(pages):
+            entry = self.entries.get(page.uid)
+            if entry is None:
+                continue
+            old = entry["file"]
+            if page.uid in outdated:
+                if old != page_filename(i, options):
+                    (self.folder / old).unlink(missing_ok=True)
+                del self.entries[page.uid]
+                continue
+            new = f"{i + 1:03d}{Path(old).suffix}"  # keeps the format it was exported in
+            if new != old and (self.folder / old).exists():
+                moves.append((page.uid, old, new))
+        # Through temporary names, pages may have swapped places
+        for uid, old, new in moves:
+            os.replace(self.folder / old, self.folder / f".{uid}.moving")
+        for uid, old, new in moves:
+            os.replace(self.folder / f".{uid}.moving", self.folder / new)
+            self.entries[uid]["file"] = new
+        return len(moves)
+
+
+def read_merged_image(kra_fn: Path) -> bytes:
+    with ZipFile(kra_fn) as archive:
+        return archive.read("mergedimage.png")
+
+
+def write_atomic(path: Path, data: bytes):
+    tmp = path.with_name(f".{path.name}.tmp")
+    with open(tmp, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp, path)
+
+
+def _fit_width(image: Image, options: ExportOptions):
+    if options.max_width and image.width > options.max_width:
+        height = round(image.height * options.max_width / image.width)
+        image = Image.scale(image, Extent(options.max_width, height))
+    return image
+
+
+def load_page(source: Path | Image, options: ExportOptions) -> Image:
+    if isinstance(source, Path):
+        source = Image.from_bytes(read_merged_image(source), "png")
+    return _fit_width(source, options)
+
+
+def encode_page(source: Path | Image, options: ExportOptions) -> bytes:
+    """Encoded image of a page from its .kra file or already rendered pixels. Runs on worker threads."""
+    if isinstance(source, Path):
+        data = read_merged_image(source)
+        width = struct.unpack(">I", data[16:20])[0]  # from the PNG header
+        if options.format == "png" and not (options.max_width and width > options.max_width):
+            return data  # already in the right format
+        source = Image.from_bytes(data, "png")
+    image = _fit_width(source, options)
+    return bytes(image.to_bytes(EXPORT_FORMATS[options.format]))
+
+
+def export_page(source: Path | Image, target: Path, options: ExportOptions) -> Path:
+    write_atomic(target, encode_page(source, options))
+    return target
+
+
+def submit_pages(
+    pages: list[tuple[int, Page]],
+    folder: Path,
+    options: ExportOptions,
+    rendered: Optional[dict[Path, Image]] = None,
+) -> list[Future[Path]]:
+    """Queue export of (index, page) pairs. `rendered` has pixels for pages whose .kra file is
+    outdated, eg. because they are open with unsaved changes."""
+    rendered = rendered or {}
+    folder.mkdir(parents=True, exist_ok=True)
+    return [
+        executor.submit(
+            export_page, rendered.get(page.kra_fn, page.kra_fn), folder / page_filename(i, options), options
+        )
+        for i, page in pages
+    ]
+
+
+def prepare_export(
+    manifest: ExportManifest,
+    pages: list[Page],
+    options: ExportOptions,
+    numbers: Optional[set[int]] = None,
+    rendered: Optional[dict[Path, Image]] = None,
+    force=False,
+) -> list[tuple[int, Page]]:
+    """Bring the names of existing files in line with the page order and return the (index, page)
+    pairs which must be exported. `numbers` are the 1-based page numbers to export, default all."""
+    rendered = rendered or {}
+    outdated = [
+        (i, page)
+        for i, page in enumerate(pages)
+        if (numbers is None or i + 1 in numbers)
+        and (force or page.kra_fn in rendered or not manifest.is_current(page, options))
+    ]
+    manifest.folder.mkdir(parents=True, exist_ok=True)
+    manifest.rename_files(pages, {page.uid for _, page in outdated}, options)
+    return outdated
+
+
+def _source_stamp(manifest: ExportManifest, page: Page, rendered: dict[Path, Image]):
+    # Pixels of unsaved documents don't match any version of the .kra, export them again next time
+    return None if page.kra_fn in rendered else manifest.source_stamp(page.kra_fn)
+
+
+async def export_pages(
+    pages: list[Page],
+    folder: Path,
+    options: ExportOptions,
+    numbers: Optional[set[int]] = None,
+    rendered: Optional[dict[Path, Image]] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+    force=False,
+) -> list[Path]:
+    """Export the project's `pages` (1-based `numbers`, default all) which changed since the
+    last export to `folder`. Returns the files written."""
+    rendered = rendered or {}
+    manifest = ExportManifest.load(folder)
+    outdated = prepare_export(manifest, pages, options, numbers, rendered, force)
+    futures = submit_pages(outdated, folder, options, rendered)
+    by_future = {executor.wrap(f): page for f, (_, page) in zip(futures, outdated)}
+    results = []
+    try:
+        if progress:
+            progress(0, len(futures))
+        pending = set(by_future)
+        while pending:
+            finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in finished:
+                page = by_future[future]
+                path = future.result()
+                manifest.record(page, path.name, options, _source_stamp(manifest, page, rendered))
+                results.append(path)
+            if progress:
+                progress(len(results), len(futures))
+    except BaseException:
+        executor.cancel_all(futures)
+        raise
+    finally:
+        manifest.save()
+    return results
+
+
+def export_project(
+    project_folder: Path,
+    folder: Path,
+    options: ExportOptions,
+    numbers: Optional[set[int]] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+    force=False,
+) -> list[Path]:
+    """Blocking version of `export_pages` for use without Krita."""
+    project = Project.load(project_folder / PROJECT_FN)
+    manifest = ExportManifest.load(folder)
+    outdated = prepare_export(manifest, project.pages, options, numbers, force=force)
+    futures = submit_pages(outdated, folder, options)
+    pages = {f: page for f, (_, page) in zip(futures, outdated)}
+    try:
+        results = []
+        if progress:
+            progress(0, len(futures))
+        for future in as_completed(futures):
+            page = pages[future]
+            results.append(future.result())
+            manifest.record(page, results[-1].name, options, manifest.source_stamp(page.kra_fn))
+            if progress:
+                progress(len(results), len(futures))
+        return results
+    except BaseException:
+        executor.cancel_all(futures)
+        raise
+    finally:
+        manifest.save()
+
+
+class CbzWriter:
+    """Comic book archive, images are stored without compressing them again."""
+
+    def __init__(self, path: Path, options: ExportOptions, title=""):
+        self.options = options
+        self._zip = ZipFile(path, "w", zipfile.ZIP_STORED)
+
+    def render(self, source: Path | Image):
+        return encode_page(source, self.options)
+
+    def add(self, index: int, data: bytes):
+        self._zip.writestr(page_filename(index, self.options), data)
+
+    def close(self):
+        self._zip.close()
+
+
+class PdfWriter:
+    """PDF with one page per image, each page has the size of its image at 72 dpi."""
+
+    def __init__(self, path: Path, options: ExportOptions, title=""):
+        self.options = options
+        self._writer = QPdfWriter(str(path))
+        self._writer.setTitle(title)
+        self._writer.setResolution(72)
+        self._painter: QPainter | None = None
+
+    def render(self, source: Path | Image):
+        return load_page(source, self.options)
+
+    def add(self, index: int, image: Image):
+        size = QPageSize(QSizeF(image.width, image.height), QPageSize.Unit.Point, "", QPageSize.SizeMatchPolicy.ExactMatch)
+        self._writer.setPageSize(size)
+        self._writer.setPageMargins(QMarginsF(0, 0, 0, 0))
+        if self._painter is None:
+            self._painter = QPainter(self._writer)
+        else:
+            self._writer.newPage()
+        self._painter.drawImage(QRectF(0, 0, image.width, image.height), image._qimage)
+
+    def close(self):
+        if self._painter is not None:
+            self._painter.end()
+
+
+BUNDLE_WRITERS = {"cbz": CbzWriter, "pdf": PdfWriter}
+
+
+def bundle_format(path: Path):
+    format = path.suffix.lower().lstrip(".")
+    if format not in BUNDLE_WRITERS:
+        raise ValueError(f"Unsupported bundle format {path.suffix}, use one of {BUNDLE_FORMATS}")
+    return format
+
+
+async def export_bundle(
+    pages: list[Page],
+    path: Path,
+    options: ExportOptions,
+    title="",
+    rendered: Optional[dict[Path, Image]] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> Path:
+    """Write `pages` in order into a CBZ or PDF file, depending on the extension of `path`. At
+    most BUNDLE_WINDOW pages are rendered or waiting for the writer at any time.
+    Pages are rendered on the thread pool. The writer (a QPainter for PDF) is created, used and
+    closed on a single thread of its own."""
+    rendered = rendered or {}
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.tmp")
+    writer_thread = ThreadPoolExecutor(1, thread_name_prefix="ftm-bundle")
+    create_writer = BUNDLE_WRITERS[bundle_format(path)]
+    sources = [rendered.get(page.kra_fn, page.kra_fn) for page in pages]
+    queued: deque[Future] = deque()
+    opened = writer_thread.submit(create_writer, tmp, options, title)
+    try:
+        writer = await executor.wrap(opened)
+        for source in sources[:BUNDLE_WINDOW]:
+            queued.append(executor.submit(writer.render, source))
+        for i in range(len(sources)):
+            data = await executor.wrap(queued.popleft())
+            if i + BUNDLE_WINDOW < len(sources):
+                queued.append(executor.submit(writer.render, sources[i + BUNDLE_WINDOW]))
+            # Appending overlaps with rendering the following pages
+            await executor.wrap(writer_thread.submit(writer.add, i, data))
+            del data
+            if progress:
+                progress(i + 1, len(sources))
+        await executor.wrap(writer_thread.submit(writer.close))
+        os.replace(tmp, path)
+    except BaseException:
+        executor.cancel_all(list(queued))
+        # Queued behind a page which may still be added, the caller doesn't wait for it
+        writer_thread.submit(_discard_bundle, opened, tmp)
+        raise
+    finally:
+        writer_thread.shutdown(wait=False)
+    return path
+
+
+def _discard_bundle(opened: Future, tmp: Path):
+    """Close the writer of a failed export and remove the partial file, on the writer's thread."""
+    try:
+        if not opened.cancelled() and opened.exception() is None:
+            opened.result().close()
+    except Exception as e:
+        log.warning(f"Failed to close {tmp}: {e}")
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def export_project_bundle(
+    project_folder: Path,
+    path: Path,
+    options: ExportOptions,
+    numbers: Optional[set[int]] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> Path:
+    """Blocking version of `export_bundle` for use without Krita."""
+    project = Project.load(project_folder / PROJECT_FN)
+    pages = [p for i, p in enumerate(project.pages) if numbers is None or i + 1 in numbers]
+    return eventloop.run_until_complete(export_bundle(pages, path, options, project.title, progress=progress))
+
+
+def parse_page_numbers(text: str) -> set[int]:
+    """Parse a page selection like "1-5,8"."""
+    numbers: set[int] = set()
+    for part in text.split(","):
+        first, _, last = part.strip().partition("-")
+        numbers.update(range(int(first), int(last or first) + 1))
+    return numbers
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description="Export the pages of a project to image files")
+    parser.add_argument("project", type=Path, help="project folder (containing project.json)")
+    parser.add_argument("output", type=Path, help="folder to write the images to, or a .cbz/.pdf file")
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="png")
+    parser.add_argument("--max-width", type=int, default=0, help="scale down wider pages")
+    parser.add_argument("--pages", type=parse_page_numbers, help='page selection, eg. "1-5,8"')
+    parser.add_argument("--force", action="store_true", help="export pages which didn't change too")
+    args = parser.parse_args(argv)
+    options = ExportOptions(args.format, args.max_width)
+
+    def progress(done: int, total: int):
+        print(f"[{done}/{total}] {args.output}")
+
+    try:
+        if args.output.suffix.lower().lstrip(".") in BUNDLE_FORMATS:
+            # QPdfWriter needs a GUI application, which doesn't need a display with this platform
+            _app = QCoreApplication.instance() or QGuiApplication(["export", "-platform", "offscreen"])
+            export_project_bundle(args.project, args.output, options, args.pages, progress)
+        else:
+            _app = QCoreApplication.instance() or QCoreApplication([])  # for Qt's image format plugins
+            export_project(args.project, args.output, options, args.pages, progress, args.force)
+    finally:
+        executor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
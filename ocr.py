@@ -0,0 +1,138 @@
+"""Optical character recognition of the source text under masks.
+
+Backends receive batches of PNG images and return one text per image. Results are cached on
+disk, keyed by the backend and a hash of the crop's pixels, so running OCR again on pages which
+didn't change doesn't reach the backend at all.
+"""
+from __future__ import annotations
+import asyncio
+from abc import ABC, abstractmethod
+import base64
+import hashlib
+import json
+import shlex
+import urllib.request
+from pathlib import Path
+
+from .commons.image import Image, ImageFileFormat
+from .commons.settings import settings
+from .commons.util import batched, create_process, user_data_dir, client_logger as log
+from .commons import executor
+
+
+class OcrBackend(ABC):
+    """Recognizes the text of a batch of PNG images."""
+
+    name: str
+    batch_size = 16
+
+    @abstractmethod
+    async def recognize(self, images: list[bytes]) -> list[str]: ...
+
+    @staticmethod
+    def _encode(images: list[bytes]):
+        return json.dumps([base64.b64encode(img).decode("ascii") for img in images]).encode()
+
+    @staticmethod
+    def _decode(data: bytes, count: int) -> list[str]:
+        texts = json.loads(data)
+        if not isinstance(texts, list) or len(texts) != count:
+            raise ValueError(f"OCR backend returned {texts!r:.200} for {count} images")
+        return [str(t) for t in texts]
+
+
+class SubprocessOcr(OcrBackend):
+    """Runs a local program for each batch, images go to stdin and texts come from stdout."""
+
+    def __init__(self, command: str):
+        self.command = shlex.split(command)
+        self.name = f"cmd:{command}"
+
+    async def recognize(self, images: list[bytes]) -> list[str]:
+        process = await create_process(
+            self.command[0], *self.command[1:], pipe_stderr=True, pipe_stdin=True
+        )
+        out, err = await process.communicate(self._encode(images))
+        if process.returncode != 0:
+            message = err.decode(errors="replace").strip()
+            raise RuntimeError(f"OCR command exited with {process.returncode}: {message}")
+        return self._decode(out, len(images))
+
+
+class HttpOcr(OcrBackend):
+    """Posts each batch to a local server."""
+
+    timeout = 120
+
+    def __init__(self, url: str):
+        self.url = url
+        self.name = f"http:{url}"
+
+    async def recognize(self, images: list[bytes]) -> list[str]:
+        return await executor.run_in_thread(self._post, images)
+
+    def _post(self, images: list[bytes]):
+        headers = {"Content-Type": "application/json"}
+        request = urllib.request.Request(self.url, self._encode(images), headers, method="POST")
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return self._decode(response.read(), len(images))
+
+
+def backend_from_settings() -> OcrBackend | None:
+    if settings.ocr_url:
+        return HttpOcr(settings.ocr_url)
+    if settings.ocr_command:
+        return SubprocessOcr(settings.ocr_command)
+    return None
+
+
+class OcrCache:
+    """Recognized texts on disk, one small file per crop."""
+
+    def __init__(self, folder: Path = user_data_dir / "ocr_cache"):
+        self.folder = folder
+
+    @staticmethod
+    def key(backend: OcrBackend, crop: Image):
+        h = hashlib.sha256(backend.name.encode())
+        h.update(f"{crop.width}x{crop.height}".encode())
+        h.update(crop.packed_bytes())
+        return h.hexdigest()
+
+    def _path(self, key: str):
+        return self.folder / key[:2] / f"{key}.txt"
+
+    def get(self, key: str) -> str | None:
+        try:
+            return self._path(key).read_text(encoding="utf-8")
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, text: str):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(text, encoding="utf-8")
+        tmp.replace(path)
+
+
+class OcrEngine:
+    def __init__(self, backend: OcrBackend, cache: OcrCache | None = None):
+        self.backend = backend
+        self.cache = cache or OcrCache()
+
+    async def recognize(self, crops: list[Image]) -> list[str]:
+        keys = [OcrCache.key(self.backend, crop) for crop in crops]
+        results = [self.cache.get(key) for key in keys]
+        missing = [i for i, text in enumerate(results) if text is None]
+        if missing:
+            log.info(f"OCR: {len(crops) - len(missing)} cached, {len(missing)} sent to {self.backend.name}")
+        for batch in batched(missing, self.backend.batch_size):
+            encoded = await asyncio.gather(
+                *(crops[i].to_bytes_async(ImageFileFormat.png) for i in batch)
+            )
+            texts = await self.backend.recognize([bytes(data) for data in encoded])
+            for i, text in zip(batch, texts):
+                results[i] = text
+                self.cache.put(keys[i], text)
+        return [text or "" for text in results]
@@ -0,0 +1,106 @@
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+from krita import Krita, Document
+from PyQt5.QtCore import QObject, QTimer
+from .datatypes import Page
+from .project_watcher import ProjectWatcher
+from .document_session import DocumentSession
+
+# Pages before/after the current one which are opened ahead of time
+PREFETCH_RADIUS = 1
+# Maximum number of warm (opened, but not shown) documents
+WARM_CAPACITY = 2
+# Delay after a page switch before prefetching starts, keeps quick page flipping responsive
+PREFETCH_DELAY = 300
+
+
+class PagePrefetcher(QObject):
+    """Opens the documents of neighbouring pages without a view while the user works on the
+    current page. open_page takes a warm document from here instead of loading it again.
+    Krita can only open documents on the UI thread, so prefetching happens one document at
+    a time when the event loop is idle.
+    """
+    __instance = None
+    @classmethod
+    def instance(cls):
+        if cls.__instance is None:
+            cls.__instance=cls()
+        return cls.__instance
+
+    _warm: "OrderedDict[Path, Document]"
+    _queue: list[Page]
+
+    def __init__(self):
+        super().__init__()
+        self._warm = OrderedDict()
+        self._queue = []
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self.prefetchNext)
+        ProjectWatcher.instance().page_changed.connect(self.pageChanged)
+        ProjectWatcher.instance().project_changed.connect(lambda _: self.clear())
+
+    def pageChanged(self, page: Page, index: int):
+        project = ProjectWatcher.instance().project
+        if project is None:
+            return
+        pages = project.pages
+        neighbours = []
+        for offset in range(1, PREFETCH_RADIUS + 1):
+            neighbours += [index + offset, index - offset]
+        wanted = [pages[i] for i in neighbours if 0 <= i < len(pages)]
+        wanted_fns = {x.kra_fn for x in wanted}
+
+        # The current page is shown now, it doesn't count as warm anymore
+        self._warm.pop(page.kra_fn, None)
+        for kra_fn in [x for x in self._warm if x not in wanted_fns]:
+            self._close(kra_fn)
+
+        open_fns = _opened_files()
+        self._queue = [x for x in wanted if x.kra_fn not in self._warm and x.kra_fn not in open_fns]
+        if self._queue:
+            self._timer.start(PREFETCH_DELAY)
+
+    def prefetchNext(self):
+        if not self._queue:
+            return
+        page = self._queue.pop(0)
+        if page.kra_fn.exists() and page.kra_fn not in _opened_files():
+            doc = Krita.instance().openDocument(str(page.kra_fn))
+            if doc is not None:
+                self._warm[page.kra_fn] = doc
+                self._trim()
+                DocumentSession.instance().track(doc)
+        if self._queue:
+            self._timer.start(0)
+
+    def take(self, kra_fn: Path) -> Optional[Document]:
+        """Hand over a warm document, the caller is responsible for showing it."""
+        doc = self._warm.pop(kra_fn, None)
+        if doc is not None and doc not in Krita.instance().documents():
+            return None  # Closed behind our back
+        return doc
+
+    def clear(self):
+        self._queue = []
+        self._timer.stop()
+        for kra_fn in list(self._warm):
+            self._close(kra_fn)
+
+    def _trim(self):
+        while len(self._warm) > WARM_CAPACITY:
+            self._close(next(iter(self._warm)))
+
+    def _close(self, kra_fn: Path):
+        doc = self._warm.pop(kra_fn)
+        if doc in Krita.instance().documents():
+            # Warm documents have no view, changes made to them (eg. by scripts) would be lost
+            if doc.modified():
+                doc.setBatchmode(True)
+                doc.save()
+            doc.close()
+
+
+def _opened_files():
+    return {Path(doc.fileName()) for doc in Krita.instance().documents()}
@@ -1,17 +1,51 @@
 from typing import Union, cast
 from krita import DockWidget,Krita
-from PyQt5.QtWidgets import QSplitter, QWidget, QVBoxLayout, QLabel, QListWidget, QListWidgetItem
-from PyQt5.QtGui import QPixmap
+from PyQt5.QtWidgets import (QSplitter, QWidget, QVBoxLayout, QLabel, QListWidget, QListWidgetItem,
+                             QTreeWidget, QTreeWidgetItem, QHBoxLayout, QPushButton, QProgressBar,
+                             QFileDialog, QInputDialog, QMenu)
+from PyQt5.QtGui import QPixmap, QFont
 from PyQt5.QtCore import Qt, pyqtSignal
 from pathlib import Path
-from .datatypes import Project,Page
+from .datatypes import Project,Page,Series,Chapter,PROJECT_FN
 from .project_watcher import ProjectWatcher
-from .commons.util import ensure
+from .page_prefetcher import PagePrefetcher
+from .document_session import DocumentSession
+from .export import EXPORT_FORMATS, BUNDLE_FORMATS, ExportOptions, export_pages, export_bundle
+from .commons.image import Image, Extent
+from .commons.util import ensure, client_logger as log
+from .commons import eventloop
 
 DOCKER_TITLE = 'Fan Translate Page Managing Docker'
 THM_RECT = 64
 
 
+def open_page(page:Page):
+    krita_inst = Krita.instance()
+    kra_fn = page.kra_fn
+    win = krita_inst.activeWindow()
+    for vw in win.views():
+        if Path(vw.document().fileName()) == kra_fn:
+            win.activate()
+            win.showView(vw)
+            vw.setVisible()
+            return
+    # If not open, use the prefetched document or open it and set it as active
+    doc = PagePrefetcher.instance().take(kra_fn) or krita_inst.openDocument(str(kra_fn))
+    win.addView(doc)
+    DocumentSession.instance().track(doc)
+
+
+def _rendered_pages(pages:list[Page]) -> dict[Path, Image]:
+    # The .kra files of documents with unsaved changes are outdated, export what is shown instead
+    kra_fns = {page.kra_fn for page in pages}
+    rendered = {}
+    for doc in Krita.instance().documents():
+        if doc.fileName() and Path(doc.fileName()) in kra_fns and doc.modified():
+            extent = Extent(doc.width(), doc.height())
+            rendered[Path(doc.fileName())] = Image.from_buffer(doc.pixelData(0, 0, *extent), extent)
+    return rendered
+
+
 class DraggableContainer(QWidget):
     def __init__(self, page:Page, thumb, index):
         super().__init__()
@@ -32,6 +66,7 @@ class DraggableContainer(QWidget):
         
         self.page_number = QLabel(f"Page {index + 1}")
         self.page_number.setAlignment(Qt.AlignCenter)
+        self.setToolTip(page.og_fn)
         
         layout.addWidget(self.thumbnail)
         layout.addWidget(self.page_number)
@@ -40,18 +75,7 @@ class DraggableContainer(QWidget):
             
     def mouseDoubleClickEvent(self, event):
         if event.button() == Qt.LeftButton:
-            krita_inst = Krita.instance()
-            kra_fn = self.page.kra_fn
-            win = krita_inst.activeWindow()
-            for vw in win.views():
-                if Path(vw.document().fileName()) == kra_fn:
-                    win.activate()
-                    win.showView(vw)
-                    vw.setVisible()
-                    return
-            # If not open, open the document and set it as active
-            doc = krita_inst.openDocument(str(kra_fn))
-            win.addView(doc)
+            open_page(self.page)
 
 class ThumbnailGrid(QListWidget):
     reordered = pyqtSignal()
@@ -89,9 +113,26 @@ class ThumbnailGrid(QListWidget):
             item = self.item(i)
             container = cast(DraggableContainer,self.itemWidget(item))
             new_order.append(container.page)
-        self.project.pages = new_order
+        self.project.reorder(new_order)
         self.update_thumbnails()
         self.reordered.emit()
+
+    def contextMenuEvent(self, event):
+        item = self.itemAt(event.pos())
+        if item is None:
+            return
+        container = cast(DraggableContainer,self.itemWidget(item))
+        menu = QMenu(self)
+        rename = menu.addAction("Rename...")
+        if menu.exec_(event.globalPos()) == rename:
+            self.rename_page(container.page)
+
+    def rename_page(self, page:Page):
+        name, ok = QInputDialog.getText(self, "Rename Page", "Name", text=page.og_fn)
+        if ok and name:
+            self.project.rename_page(page, name)
+            self.project.save()
+            self.update_thumbnails()
         
     # def on_item_clicked(self, item):
     #     if self.current_selected:
@@ -102,11 +143,56 @@ class ThumbnailGrid(QListWidget):
     #     self.current_selected = item
 
 
+CHAPTER_ROLE = Qt.UserRole
+PAGE_ROLE = Qt.UserRole + 1
+
+class ChapterTree(QTreeWidget):
+    """Chapters of a series. Page items of a chapter are only created (and the chapter's
+    project only loaded) when the chapter is expanded."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setHeaderHidden(True)
+        self.itemExpanded.connect(self.populate_chapter)
+        self.itemDoubleClicked.connect(self.open_item)
+
+    def update_series(self, series:Union[Series,None], current:Union[Project,None]):
+        self.clear()
+        if series is None:
+            return
+        for chapter in series.chapters:
+            item = QTreeWidgetItem(self, [chapter.title])
+            item.setData(0, CHAPTER_ROLE, chapter)
+            item.setChildIndicatorPolicy(QTreeWidgetItem.ShowIndicator)
+            if current is not None and chapter.is_loaded and chapter.project is current:
+                font = QFont(item.font(0))
+                font.setBold(True)
+                item.setFont(0, font)
+
+    def populate_chapter(self, item:QTreeWidgetItem):
+        chapter = item.data(0, CHAPTER_ROLE)
+        if chapter is None or item.childCount() > 0:
+            return
+        chapter = cast(Chapter, chapter)
+        if not (chapter.path / PROJECT_FN).exists():
+            item.setChildIndicatorPolicy(QTreeWidgetItem.DontShowIndicator)
+            return
+        for i, page in enumerate(chapter.project.pages):
+            child = QTreeWidgetItem(item, [f"Page {i + 1}"])
+            child.setData(0, PAGE_ROLE, page)
+
+    def open_item(self, item:QTreeWidgetItem):
+        page = item.data(0, PAGE_ROLE)
+        if page is not None:
+            open_page(page)
+
+
 class ProjectManagerDocker(DockWidget):
 
     def __init__(self):
         super().__init__()
         self.project=None
+        self.series=None
         self.setWindowTitle(DOCKER_TITLE)
         
         base = QVBoxLayout()
@@ -115,14 +201,35 @@ class ProjectManagerDocker(DockWidget):
         self.thumbnail_grid = ThumbnailGrid(widget)
         self.thumbnail_grid.reordered.connect(self.thumbnailReordered)
 
+        self.chapter_tree = ChapterTree(widget)
+        self.chapter_tree.setVisible(False)
+
         baseLayout = QSplitter()
         base.addWidget(baseLayout)
+        base.addWidget(self.chapter_tree)
         base.addWidget(self.thumbnail_grid)
         self.label1 = QLabel("Path here")
         base.addWidget(self.label1)
+
+        export_layout = QHBoxLayout()
+        self.export_btn = QPushButton("Export...")
+        self.export_btn.clicked.connect(self.exportPages)
+        self.export_progress = QProgressBar()
+        self.export_progress.setVisible(False)
+        export_layout.addWidget(self.export_btn)
+        export_layout.addWidget(self.export_progress)
+        base.addLayout(export_layout)
         self.setWidget(widget)
 
+        PagePrefetcher.instance()
+        DocumentSession.instance()  # tracks pages activated before any is opened from here
+        ProjectWatcher.instance().series_changed.connect(self.watchSeriesChange)
         ProjectWatcher.instance().project_changed.connect(self.watchActiveDocumentChange)
+
+    def watchSeriesChange(self,series:Union[Series,None]):
+        self.series=series
+        self.chapter_tree.setVisible(series is not None)
+        self.chapter_tree.update_series(series,self.project)
     
     def thumbnailReordered(self):
         self.project=self.thumbnail_grid.project
@@ -137,7 +244,66 @@ class ProjectManagerDocker(DockWidget):
         self.thumbnail_grid.update_project(self.project)
         self.thumbnail_grid.update_thumbnails()
         self.label1.setText("Project "+project.title)
+        if self.series is not None:
+            self.chapter_tree.update_series(self.series,project)
+
+
+    def exportPages(self):
+        if self.project is None:
+            return
+        formats = list(EXPORT_FORMATS) + list(BUNDLE_FORMATS)
+        format, ok = QInputDialog.getItem(self, "Export", "Format", formats, 0, False)
+        if not ok:
+            return
+        # Selected thumbnails, or all pages
+        numbers = {cast(DraggableContainer, self.thumbnail_grid.itemWidget(item)).index + 1
+                   for item in self.thumbnail_grid.selectedItems()}
+        if format in BUNDLE_FORMATS:
+            default = str(self.project.root_path / f"{self.project.title or 'chapter'}.{format}")
+            file, _ = QFileDialog.getSaveFileName(self, "Export Bundle", default, f"{format.upper()} (*.{format})")
+            if not file:
+                return
+            eventloop.run(self.runBundleExport(Path(file).with_suffix(f".{format}"), numbers or None))
+            return
+        folder = QFileDialog.getExistingDirectory(self, "Export Folder")
+        if not folder:
+            return
+        eventloop.run(self.runExport(Path(folder), ExportOptions(format), numbers or None))
+
+    def exportProgress(self, done:int, total:int):
+        self.export_progress.setRange(0, total)
+        self.export_progress.setValue(done)
+
+    async def runExport(self, folder:Path, options:ExportOptions, numbers:Union[set[int],None]):
+        pages = self.project.pages
+        self.export_btn.setEnabled(False)
+        self.export_progress.setVisible(True)
+        try:
+            selected = [page for i, page in enumerate(pages) if numbers is None or i + 1 in numbers]
+            rendered = _rendered_pages(selected)
+            paths = await export_pages(pages, folder, options, numbers, rendered, self.exportProgress)
+            total = len(numbers) if numbers else len(pages)
+            self.label1.setText(f"Exported {len(paths)} pages to {folder}, {total - len(paths)} unchanged")
+        except Exception as e:
+            log.exception(f"Export failed: {e}")
+            self.label1.setText(f"Export failed: {e}")
+        finally:
+            self.export_btn.setEnabled(True)
+            self.export_progress.setVisible(False)
 
+    async def runBundleExport(self, file:Path, numbers:Union[set[int],None]):
+        pages = [page for i, page in enumerate(self.project.pages) if numbers is None or i + 1 in numbers]
+        self.export_btn.setEnabled(False)
+        self.export_progress.setVisible(True)
+        try:
+            await export_bundle(pages, file, ExportOptions(), self.project.title, _rendered_pages(pages), self.exportProgress)
+            self.label1.setText(f"Exported {len(pages)} pages to {file}")
+        except Exception as e:
+            log.exception(f"Export failed: {e}")
+            self.label1.setText(f"Export failed: {e}")
+        finally:
+            self.export_btn.setEnabled(True)
+            self.export_progress.setVisible(False)
 
     def canvasChanged(self, canvas):
         pass
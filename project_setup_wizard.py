@@ -1,9 +1,14 @@
 from pathlib import Path
 from typing import cast
 from PyQt5.QtWidgets import (QWizard, QWizardPage, QLineEdit, QVBoxLayout, QLabel, QProgressDialog,
-                             QFileDialog, QPushButton, QListWidget, QAbstractItemView, QHBoxLayout)
+                             QFileDialog, QPushButton, QListWidget, QAbstractItemView, QHBoxLayout,
+                             QCheckBox)
 from krita import Krita, Extension
-from .datatypes import Page, Project
+from .archives import ArchiveEntry, Source, create_document, decode_sources, expand_sources
+from .datatypes import Page, Project, Series
+from .translate_docker import detect_chapter_bubbles
+from .commons.util import ensure
+from .commons import eventloop
 
 
 class ProjectSetupWizard(QWizard):
@@ -20,11 +25,11 @@ class ProjectSetupWizard(QWizard):
     def accept(self):
         project_title = self.field("projectTitle")
         project_folder = Path(self.field("projectFolder"))
-        selected_files = self.field("selectedFiles")
+        sources = cast(ImageImportPage,self.page(1)).sources
         
         # Get the reordered file list
         image_order_page = cast(ImageOrderPage,self.page(2))
-        reordered_files = [selected_files[i] for i in image_order_page.get_file_order()]
+        reordered_files = [sources[i] for i in image_order_page.get_file_order()]
 
         project = Project(project_folder)
         project.title = project_title
@@ -36,19 +41,40 @@ class ProjectSetupWizard(QWizard):
         progress_dialog.setWindowTitle("Progress")
         progress_dialog.show()
 
-        for i, file_path in enumerate(reordered_files):
-            project.add_page(krita_inst, file_path)
+        # Archive entries are decoded from memory in the background while Krita imports pages
+        pages = decode_sources(reordered_files)
+        for i, (source, image) in enumerate(pages):
+            if isinstance(source, ArchiveEntry):
+                doc = create_document(krita_inst, source.filename, ensure(image))
+                project.add_page(krita_inst, source.filename, doc)
+            else:
+                project.add_page(krita_inst, source)
             progress_dialog.setValue(i + 1)
             if progress_dialog.wasCanceled():
                 break
+        pages.close()
 
         progress_dialog.close()
         
         project.save()
+        if self.field("addToSeries"):
+            series = Series.load_or_create(project_folder.parent)
+            series.add_chapter(project_folder, project_title)
+            series.save()
         newdoc=krita_inst.openDocument(str(project.pages[0].kra_fn))
         krita_inst.activeWindow().addView(newdoc)
+        if self.field("detectBubbles"):
+            self.detect_bubbles(project)
         super().accept()
 
+    def detect_bubbles(self, project:Project):
+        window = Krita.instance().activeWindow().qwindow()
+        progress = QProgressDialog("Detecting speech bubbles...", None, 0, len(project.pages), window)
+        progress.setWindowTitle("Progress")
+        progress.show()
+        task = eventloop.run(detect_chapter_bubbles(project.pages, progress.setValue))
+        task.add_done_callback(lambda _: progress.close())
+
 class ProjectInfoPage(QWizardPage):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -75,10 +101,18 @@ class ProjectInfoPage(QWizardPage):
         folder_layout.addWidget(self.folder_button)
         layout.addLayout(folder_layout)
 
+        # Series
+        self.series_check = QCheckBox("Add as a chapter of the series in the parent folder")
+        layout.addWidget(self.series_check)
+        self.bubbles_check = QCheckBox("Detect speech bubbles and add masks for them")
+        layout.addWidget(self.bubbles_check)
+
         self.setLayout(layout)
 
         self.registerField("projectTitle*", self.title_edit)
         self.registerField("projectFolder*", self.folder_edit)
+        self.registerField("addToSeries", self.series_check)
+        self.registerField("detectBubbles", self.bubbles_check)
 
     def select_folder(self):
         folder = QFileDialog.getExistingDirectory(self, "Select Project Folder")
@@ -102,12 +136,16 @@ class ImageImportPage(QWizardPage):
 
         self.registerField("selectedFiles", self, "selectedFiles")
         self.setProperty("selectedFiles", [])
+        self.sources:list[Source] = []
 
     def select_files(self):
-        files, _ = QFileDialog.getOpenFileNames(self, "Select Images", "", "Image Files (*.png *.jpg *.bmp *.tiff)")
+        files, _ = QFileDialog.getOpenFileNames(self, "Select Images", "",
+                                                "Images and Archives (*.png *.jpg *.jpeg *.bmp *.tiff *.webp *.zip *.cbz)")
         if files:
-            self.setProperty("selectedFiles", files)
-            self.file_label.setText(f"{len(files)} file(s) selected")
+            # Archives are replaced by the images they contain
+            self.sources = expand_sources(files)
+            self.setProperty("selectedFiles", [str(x) for x in self.sources])
+            self.file_label.setText(f"{len(self.sources)} image(s) selected from {len(files)} file(s)")
 
 class DraggableListWidget(QListWidget):
     def __init__(self, parent=None):
@@ -1,10 +1,12 @@
 from krita import DockWidget,Krita
-from PyQt5.QtCore import Qt, QMimeData, pyqtSignal, QTimer,QObject
+from PyQt5.QtCore import Qt, QMimeData, pyqtSignal, QObject
 from pathlib import Path
-from .datatypes import Project,Page
+from .datatypes import Project,Page,Series,PROJECT_FN
+from .commons import scheduler
 
 class ProjectWatcher(QObject):
     project_changed = pyqtSignal(Project)
+    series_changed = pyqtSignal(object)
     page_changed = pyqtSignal(Page,int)
     __instance = None
     @classmethod
@@ -15,39 +17,55 @@ class ProjectWatcher(QObject):
 
     def __init__(self):
         super(ProjectWatcher,self).__init__()
-        self.watcher = QTimer(self)
-        self.watcher.timeout.connect(self.watchActiveDocChange)
-        self.watcher.setInterval(1000)
-        self.watcher.start(500)
+        self.watcher = scheduler.register(self.watchActiveDocChange, 500)
 
         self._prev_project = None
         self._prev_page = None
-    
+        self._prev_filename = None
+        self._prev_series = None
+        self.project = None
+        self.series = None
+
+    def checkSeries(self,project_root:Path):
+        series_json = Series.find_for(project_root)
+        if self._prev_series == series_json:
+            return
+        self.series = Series.load(series_json) if series_json is not None else None
+        self.series_changed.emit(self.series)
+        self._prev_series = series_json
+
     def checkProject(self,filename):
-        project_json = Path(filename).parent.parent / "project.json"
+        project_json = Path(filename).parent.parent / PROJECT_FN
         if self._prev_project == project_json:
             return
         if project_json.exists(): 
-            self.project=Project.load(project_json)
+            self.checkSeries(project_json.parent)
+            # Chapters of a series keep their project once loaded, switching back is free
+            chapter = self.series.chapter_for(project_json.parent) if self.series else None
+            self.project = chapter.project if chapter else Project.load(project_json)
         else:
             self.project = None
-            self._prev_page=None
+        self._prev_page = None
         self.project_changed.emit(self.project)
         self._prev_project = project_json
     
-    # def checkPage(self,filename):
-    #     if self.project is None or self._prev_page == filename: 
-    #         return
-    #     current_page=None
-    #     for idx,pg in enumerate(self.project.pages):
-
-    #     self.page_changed.emit()
-    #     self._prev_page = filename
-
+    def checkPage(self,filename):
+        if self.project is None or self._prev_page == filename: 
+            return
+        index = self.project.page_index(Path(filename))
+        if index is not None:
+            self.page_changed.emit(self.project.pages[index],index)
+        self._prev_page = filename
 
     def watchActiveDocChange(self):
         krita_inst = Krita.instance()
         doc = krita_inst.activeDocument()
         if doc is None:
-            return
-        self.checkProject(doc.fileName())
\ No newline at end of file
+            return False
+        filename = doc.fileName()
+        if filename == self._prev_filename:
+            return False
+        self._prev_filename = filename
+        self.checkProject(filename)
+        self.checkPage(filename)
+        return True
\ No newline at end of file
@@ -1,26 +1,41 @@
-from typing import Literal, Union, cast, SupportsFloat, Optional
-from krita import DockWidget, Document, Node, GroupLayer, VectorLayer
+from typing import Awaitable, Callable, Literal, Union, cast, SupportsFloat, Optional, TYPE_CHECKING
+from krita import DockWidget, Document, Node, GroupLayer, VectorLayer, Krita
 import krita
-from PyQt5.QtCore import QTimer, pyqtSignal
+from PyQt5.QtCore import QByteArray, pyqtSignal
 from PyQt5.QtWidgets import (QAbstractItemView, QBoxLayout, QPushButton, QHBoxLayout, QFontComboBox,
                              QWidget, QVBoxLayout, QListWidget, QListWidgetItem, QSpinBox,
-                             QComboBox, QTextEdit)
+                             QComboBox, QTextEdit, QLabel)
 from PyQt5.QtGui import QFocusEvent, QFont
 from .svgtext import guide_rect, textgen
 from .commons.document import KritaDocument
+from .commons.image import Bounds, Extent, Image, TILE_EXTENT
+from .commons.layer import LayerType
+from .commons.util import ensure, client_logger as log
+from .commons import eventloop, executor, scheduler
+from .datatypes import Page, ORIG_LAYER_NAME
+from .project_watcher import ProjectWatcher
+from .page_prefetcher import PagePrefetcher
+from . import ocr, translation
+from collections import deque
+from pathlib import Path
 from secrets import token_urlsafe
 import xml.etree.ElementTree as ET
 import inspect
 import html
+import time
 import json
 from dataclasses import dataclass, asdict
 
+if TYPE_CHECKING:
+    from . import bubbles  # needs numpy, imported on first use
+
 MASK_GRP_NAME = "ft_masks"
 TEXT_GRP_NAME = "ft_texts"
 METADATA_LAYER_NAME = "ft_metadata"
-ORIG_LAYER_NAME = "Background"
 UI_FONT_SIZE = 12
 DOCKER_TITLE = "Fan Translation Docker"
+# Pages read ahead while the previous ones are processed by workers
+PAGE_PIPELINE = 2
 
 @dataclass
 class ShapeCache:
@@ -29,11 +44,13 @@ class ShapeCache:
 
 def find_or_create_layer(doc: KritaDocument, layer_name: str, layer_type: str) -> Node:
     _doc = doc._doc
-    for node in _doc.topLevelNodes():
-        if node.type() == layer_type and node.name() == layer_name:
-            return node
+    layers = doc.layers
+    layers.update()  # only compares the top-level fingerprint unless something changed
+    for layer in layers.find_by_name(layer_name, LayerType(layer_type), parent=layers.root):
+        return layer.node
     layer = _doc.createGroupLayer(layer_name) if layer_type == "grouplayer" else _doc.createVectorLayer(layer_name)
     _doc.rootNode().addChildNode(layer, None)
+    layers.update()
     return _doc.rootNode().findChildNodes(layer_name)[-1]
 
 def get_root_group(doc: KritaDocument, group_of: Literal["text", "mask"]) -> GroupLayer:
@@ -60,19 +77,32 @@ def get_text_group_shape_by_id(doc: KritaDocument, uid: str) -> tuple[Optional[V
                 return layer, rect, text
     return None, None, None
 
+def get_guide_rects(doc: KritaDocument) -> dict[str, tuple[float, float, float, float]]:
+    grp = get_root_group(doc, "text")
+    rects = {}
+    for layer in grp.childNodes():
+        if layer.type() != "vectorlayer":
+            continue
+        for shp in cast(VectorLayer, layer).shapes():
+            elem = ET.fromstring(shp.toSvg())
+            id = elem.get("id", "")
+            if id.startswith("ft_guide/"):
+                rects[id.split("/", 1)[1]] = extract_rect_properties(elem)
+    return rects
+
 shape_cache: dict[str, ShapeCache] = {}
 
-def update_text_shape(doc: KritaDocument, uid: str, new_text: str, font: str = "Arial", size: int = UI_FONT_SIZE):
+def update_text_shape(doc: KritaDocument, uid: str, new_text: str, font: str = "Arial", size: int = UI_FONT_SIZE) -> bool:
     text_layer, rect_shape, text_shape = get_text_group_shape_by_id(doc, uid)
     if text_layer is None or rect_shape is None:
-        return
+        return False
 
     guide_rect = ET.fromstring(rect_shape.toSvg())
     x, y, w, h = extract_rect_properties(guide_rect)
     rect = (x, y, w, h)
 
     if uid in shape_cache and shape_cache[uid].rect == rect and shape_cache[uid].text == (new_text, font, size):
-        return
+        return False
 
     new_text_elem = create_new_text_element(new_text, rect, font, uid, size)
     svg_string = create_svg_string(doc._doc, new_text_elem)
@@ -82,6 +112,7 @@ def update_text_shape(doc: KritaDocument, uid: str, new_text: str, font: str = "
     text_layer.addShapesFromSvg(svg_string)
 
     shape_cache[uid] = ShapeCache(rect=rect, text=(new_text, font, size))
+    return True
 
 def extract_rect_properties(guide_rect: ET.Element) -> tuple[float, float, float, float]:
     x, y = extract_translate_values(guide_rect.get('transform', ''))
@@ -145,6 +176,177 @@ def load_page_json(doc: KritaDocument) -> list:
         pass
     return []
 
+def get_next_number(doc: KritaDocument, group: GroupLayer) -> int:
+    # Layers added or renamed inside the group don't show in the cheap update, numbers taken
+    # from a stale index would repeat
+    group_layer = doc.layers.updated(full=True).find(group.uniqueId())
+    children = doc.layers.children_of(group_layer) if group_layer else []
+    numbers = [int_tryparse(layer.name.rsplit(" ", 1)[-1]) for layer in children]
+    numbers = [num for num in numbers if num is not None]
+    return max(numbers + [0]) + 1
+
+def read_bright_runs(doc: KritaDocument) -> "bubbles.Runs":
+    from . import bubbles
+
+    # Full-width strips of about one tile, bright runs are tiny compared to the pixels
+    extent = doc.extent
+    strip = Extent(extent.width, max(1, TILE_EXTENT.pixel_count // extent.width))
+    orig = doc.layers.find_by_name(ORIG_LAYER_NAME)
+    tiles = orig[0].tiles(Bounds(0, 0, *extent), strip) if orig else doc.tiles(tile=strip)
+    return bubbles.Runs.concat([bubbles.find_runs(bubbles.threshold(t.data), t.bounds.y) for t in tiles])
+
+def add_bubble_masks(doc: KritaDocument, found: list["bubbles.Bubble"]):
+    if not found:
+        return
+    group = ensure(doc.layers.find(get_root_group(doc, "mask").uniqueId()))
+    number = get_next_number(doc, cast(GroupLayer, group.node))
+    for i, bubble in enumerate(found):
+        img = Image.from_buffer(QByteArray(bubble.pixels), Extent(bubble.width, bubble.height))
+        # Documents without a view have no active layer to restore
+        doc.layers.create(f"Mask {number + i}", img, Bounds(*bubble.bounds), make_active=not doc.is_active, parent=group)
+
+async def detect_document_bubbles(doc: KritaDocument) -> int:
+    from . import bubbles
+
+    ok, msg = doc.check_color_mode()
+    if not ok:
+        log.warning(f"Skipping bubble detection for {doc.filename}: {msg}")
+        return 0
+    found = await executor.run_in_process(bubbles.detect, read_bright_runs(doc), tuple(doc.extent))
+    add_bubble_masks(doc, found)
+    return len(found)
+
+async def clean_document_masks(doc: KritaDocument) -> int:
+    """Paint out the original text under every mask by filling the mask layer with the
+    background around it. Returns the number of pixels processed."""
+    from . import cleaning
+
+    ok, msg = doc.check_color_mode()
+    orig = doc.layers.find_by_name(ORIG_LAYER_NAME)
+    if not ok or not orig:
+        log.warning(f"Skipping mask cleaning for {doc.filename}: {msg or 'no original layer'}")
+        return 0
+    group = doc.layers.find(get_root_group(doc, "mask").uniqueId())
+    page_bounds = Bounds(0, 0, *doc.extent)
+    jobs = []
+    for mask in doc.layers.children_of(group) if group else []:
+        bounds = mask.compute_bounds()
+        if bounds.is_zero:
+            continue
+        b = cleaning.BORDER
+        bounds = Bounds.restrict(Bounds(bounds.x - b, bounds.y - b, bounds.width + 2 * b, bounds.height + 2 * b), page_bounds)
+        art = orig[0].get_pixels(bounds).packed_bytes()
+        alpha = mask.get_mask(bounds).packed_bytes()
+        jobs.append((mask, bounds, executor.wrap(executor.submit(cleaning.fill, art, alpha, tuple(bounds.extent)))))
+    for mask, bounds, job in jobs:
+        patch = await job
+        mask.write_pixels(Image.from_buffer(QByteArray(patch), bounds.extent), bounds)
+    return sum(bounds.area for _, bounds, _ in jobs)
+
+async def recognize_sources(doc: KritaDocument, uids: list[str]) -> dict[str, str]:
+    """OCR the original art under the text boxes with the given uids."""
+    backend = ocr.backend_from_settings()
+    if backend is None:
+        log.warning("No OCR backend configured, set an OCR command or server URL in the settings")
+        return {}
+    orig = doc.layers.find_by_name(ORIG_LAYER_NAME)
+    if not orig or not uids:
+        return {}
+    rects = get_guide_rects(doc)
+    page_bounds = Bounds(0, 0, *doc.extent)
+    boxes = {uid: Bounds.restrict(Bounds(*map(int, rects[uid])), page_bounds) for uid in uids if uid in rects}
+    boxes = {uid: box for uid, box in boxes.items() if box.width > 0 and box.height > 0}
+    crops = [orig[0].get_pixels(box) for box in boxes.values()]
+    texts = await ocr.OcrEngine(backend).recognize(crops)
+    return dict(zip(boxes, texts))
+
+async def recognize_page_json(doc: KritaDocument) -> int:
+    """Fill empty sources of a page which isn't shown in the docker, directly in its metadata."""
+    pairs = load_page_json(doc)
+    texts = await recognize_sources(doc, [p["uid"] for p in pairs if "uid" in p and not p.get("orig")])
+    for pair in pairs:
+        if pair.get("uid") in texts:
+            pair["orig"] = texts[pair["uid"]]
+    if texts:
+        save_page_json(doc, pairs)
+    return len(texts)
+
+async def translate_page_json(doc: KritaDocument, translator: "translation.Translator") -> int:
+    """Pre-translate empty translations of a page which isn't shown in the docker."""
+    pairs = load_page_json(doc)
+    todo = [p for p in pairs if p.get("orig") and not p.get("tran")]
+    if not todo:
+        return 0
+    for pair, text in zip(todo, await translator.translate([p["orig"] for p in todo])):
+        pair["tran"] = text
+    save_page_json(doc, pairs)
+    return len(todo)
+
+async def process_pages(pages: list[Page], action: Callable[[KritaDocument], Awaitable[int]],
+                        progress: Optional[Callable[[int], None]] = None) -> int:
+    """Run `action` on all pages and sum up its results. Krita documents can only be read on the
+    UI thread, the next pages are read while workers are busy with the previous ones. Pages which
+    aren't open (or only opened ahead by the prefetcher) are saved and closed afterwards, open
+    ones are left to the user to save."""
+    krita_inst = Krita.instance()
+    opened = {Path(d.fileName()): d for d in krita_inst.documents()}
+    pending: deque = deque()
+    total, done = 0, 0
+
+    async def finish():
+        nonlocal total, done
+        kdoc, close, task = pending.popleft()
+        try:
+            total += await task
+            if close:
+                kdoc.save()
+        except Exception as e:
+            log.exception(f"Processing {kdoc.fileName()} failed: {e}")
+        if close:
+            kdoc.close()
+        done += 1
+        if progress:
+            progress(done)
+
+    for page in pages:
+        kdoc = PagePrefetcher.instance().take(page.kra_fn)
+        close = kdoc is not None or page.kra_fn not in opened
+        if kdoc is None:
+            kdoc = opened.get(page.kra_fn) or krita_inst.openDocument(str(page.kra_fn))
+            if kdoc is None:
+                log.warning(f"Could not open {page.kra_fn}")
+                continue
+        if close:
+            kdoc.setBatchmode(True)
+            kdoc.waitForDone()
+        pending.append((kdoc, close, eventloop.run(action(KritaDocument.wrap(kdoc)))))
+        if len(pending) >= PAGE_PIPELINE:
+            await finish()
+    while pending:
+        await finish()
+    return total
+
+async def detect_chapter_bubbles(pages: list[Page], progress: Optional[Callable[[int], None]] = None) -> int:
+    """Add masks for the bubbles of all pages."""
+    total = await process_pages(pages, detect_document_bubbles, progress)
+    log.info(f"Detected {total} bubbles on {len(pages)} pages")
+    return total
+
+async def clean_pages_masks(pages_or_doc: Union[list[Page], KritaDocument]) -> str:
+    """Clean the masks of the given pages (or a single document) and report the throughput."""
+    start = time.perf_counter()
+    if isinstance(pages_or_doc, KritaDocument):
+        pixels = await clean_document_masks(pages_or_doc)
+    else:
+        pixels = await process_pages(pages_or_doc, clean_document_masks)
+    elapsed = time.perf_counter() - start
+    megapixels = pixels / 1_000_000
+    report = f"Cleaned {megapixels:.2f} MP in {elapsed:.2f} s"
+    if megapixels > 0:
+        report += f" ({elapsed / megapixels:.2f} s/MP)"
+    log.info(report)
+    return report
+
 class FocusSignalingTextEdit(QTextEdit):
     focus_in = pyqtSignal()
     
@@ -184,6 +386,7 @@ class TranslationPair(QWidget):
 
     def to_json(self):
         return {
+            "uid": self.uid,
             "orig": self.source_text.toPlainText(),
             "tran": self.translated_text.toPlainText(),
             "font": self.font,
@@ -216,6 +419,8 @@ class TranslateDocker(DockWidget):
         self.setup_text_selector(main_layout)
         self.setup_text_styler(main_layout)
         self.setup_pair_list(main_layout)
+        self.status_label = QLabel()
+        main_layout.addWidget(self.status_label)
         self.setWidget(main_widget)
 
     @ensure_active_document
@@ -234,6 +439,34 @@ class TranslateDocker(DockWidget):
         button_layout.addWidget(self.add_text_btn)
         layout.addLayout(button_layout)
 
+        batch_layout = QHBoxLayout()
+        self.detect_bubbles_btn = QPushButton("Detect Bubbles")
+        self.add_all_texts_btn = QPushButton("Texts for Masks")
+        batch_layout.addWidget(self.detect_bubbles_btn)
+        batch_layout.addWidget(self.add_all_texts_btn)
+        layout.addLayout(batch_layout)
+
+        clean_layout = QHBoxLayout()
+        self.clean_page_btn = QPushButton("Clean Masks")
+        self.clean_chapter_btn = QPushButton("Clean Chapter")
+        clean_layout.addWidget(self.clean_page_btn)
+        clean_layout.addWidget(self.clean_chapter_btn)
+        layout.addLayout(clean_layout)
+
+        ocr_layout = QHBoxLayout()
+        self.ocr_page_btn = QPushButton("OCR Page")
+        self.ocr_chapter_btn = QPushButton("OCR Chapter")
+        ocr_layout.addWidget(self.ocr_page_btn)
+        ocr_layout.addWidget(self.ocr_chapter_btn)
+        layout.addLayout(ocr_layout)
+
+        translate_layout = QHBoxLayout()
+        self.translate_page_btn = QPushButton("Translate Page")
+        self.translate_chapter_btn = QPushButton("Translate Chapter")
+        translate_layout.addWidget(self.translate_page_btn)
+        translate_layout.addWidget(self.translate_chapter_btn)
+        layout.addLayout(translate_layout)
+
     def setup_text_styler(self, layout: QBoxLayout):
         styler_layout = QHBoxLayout()
         self.font_selector = QFontComboBox()
@@ -258,26 +491,36 @@ class TranslateDocker(DockWidget):
     def setup_connections(self):
         self.add_mask_btn.clicked.connect(self.add_new_mask)
         self.add_text_btn.clicked.connect(self.add_new_text)
+        self.detect_bubbles_btn.clicked.connect(self.detect_page_bubbles)
+        self.add_all_texts_btn.clicked.connect(self.add_texts_for_masks)
+        self.clean_page_btn.clicked.connect(self.clean_page)
+        self.clean_chapter_btn.clicked.connect(self.clean_chapter)
+        self.ocr_page_btn.clicked.connect(self.ocr_page)
+        self.ocr_chapter_btn.clicked.connect(self.ocr_chapter)
+        self.translate_page_btn.clicked.connect(self.translate_page)
+        self.translate_chapter_btn.clicked.connect(self.translate_chapter)
         self.text_selector.currentIndexChanged.connect(self.update_text_list)
         self.pair_list.itemSelectionChanged.connect(self.translation_item_clicked)
         self.font_selector.currentFontChanged.connect(self.update_pair_styles)
         self.font_size_selector.valueChanged.connect(self.update_pair_styles)
-        self.watcher = QTimer(self)
-        self.watcher.setInterval(1000)
-        self.watcher.timeout.connect(self.update_shapes)
-        self.watcher.start(1000)
+        # Short backoff: undo from the menu or scripts change texts without the input that resets it
+        self.watcher = scheduler.register(self.update_shapes, 1000, max_interval=2000)
 
     @ensure_active_document
     def update_shapes(self, doc: KritaDocument):
+        changed = False
         if doc._doc.fileName() != self.current_page_fn:
             self.load_page(doc)
+            changed = True
         for pair in self.translation_pairs:
-            update_text_shape(doc, pair.uid, pair.translated_text.toPlainText(), pair.font, pair.size)
+            changed = update_text_shape(doc, pair.uid, pair.translated_text.toPlainText(), pair.font, pair.size) or changed
         
         pair_json = [pair.to_json() for pair in self.translation_pairs]
         if self.cached_pair_json != pair_json:
             self.cached_pair_json = pair_json
             save_page_json(doc, pair_json)
+            changed = True
+        return changed
 
     @ensure_active_document
     def translation_item_clicked(self, doc: KritaDocument):
@@ -293,9 +536,10 @@ class TranslateDocker(DockWidget):
     @ensure_active_document
     def add_new_mask(self, doc: KritaDocument):
         mask_group = get_root_group(doc, "mask")
-        new_mask_number = self.get_next_number(mask_group)
+        new_mask_number = get_next_number(doc, mask_group)
         new_mask = doc._doc.createNode(f"Mask {new_mask_number}", "paintlayer")
         mask_group.addChildNode(new_mask, None)
+        doc.layers.update()
 
     @ensure_active_document
     def add_new_text(self, doc: KritaDocument):
@@ -304,10 +548,11 @@ class TranslateDocker(DockWidget):
         self.add_pair_to_list(pair)
         
         text_group = get_root_group(doc, "text")
-        new_text_number = self.get_next_number(text_group)
+        new_text_number = get_next_number(doc, text_group)
         layername = f"Text {new_text_number}"
         new_text_layer = doc._doc.createNode(layername, "vectorlayer")
         text_group.addChildNode(new_text_layer, None)
+        doc.layers.update()
         
         x, y, w, h = self.get_text_bounds(doc)
         doc._doc.refreshProjection()
@@ -318,19 +563,139 @@ class TranslateDocker(DockWidget):
         pair.size = self.font_size_selector.value()
         self.update_pair_styles()
 
+    @ensure_active_document
+    def add_texts_for_masks(self, doc: KritaDocument):
+        """Create a text for every mask which doesn't have one yet, all layers are added before
+        the projection is refreshed once."""
+        layers = doc.layers
+        mask_group = layers.find(get_root_group(doc, "mask").uniqueId())
+        text_group = get_root_group(doc, "text")
+        existing = set(get_guide_rects(doc).values())
+        rects = []
+        for mask in layers.children_of(mask_group) if mask_group else []:
+            bounds = mask.compute_bounds()
+            rect = (float(bounds.x), float(bounds.y), float(bounds.width), float(bounds.height))
+            if not bounds.is_zero and rect not in existing:
+                rects.append(rect)
+        if not rects:
+            return
+
+        number = get_next_number(doc, text_group)
+        font = self.font_selector.currentFont().family()
+        size = self.font_size_selector.value()
+        for i, (x, y, w, h) in enumerate(rects):
+            pair = TranslationPair(uid=token_urlsafe(8), font=font, size=size)
+            text_layer = doc._doc.createVectorLayer(f"Text {number + i}")
+            text_group.addChildNode(text_layer, None)
+            text_layer.addShapesFromSvg(new_text_shape(pair.uid, x, y, w, h, doc._doc))
+            self.translation_pairs.append(pair)
+            self.add_pair_to_list(pair, refresh=False)
+        layers.update(full=True)
+        doc._doc.refreshProjection()
+        self.update_text_list()
+
+    @ensure_active_document
+    def detect_page_bubbles(self, doc: KritaDocument):
+        eventloop.run(detect_document_bubbles(doc))
+
+    @ensure_active_document
+    def clean_page(self, doc: KritaDocument):
+        eventloop.run(self.run_cleaning(doc))
+
+    def clean_chapter(self):
+        project = ProjectWatcher.instance().project
+        if project is not None:
+            eventloop.run(self.run_cleaning(project.pages))
+
+    async def run_cleaning(self, pages_or_doc: Union[list[Page], KritaDocument]):
+        self.status_label.setText("Cleaning masks...")
+        self.status_label.setText(await clean_pages_masks(pages_or_doc))
+
+    @ensure_active_document
+    def ocr_page(self, doc: KritaDocument):
+        eventloop.run(self.run_ocr([], doc))
+
+    def ocr_chapter(self):
+        project = ProjectWatcher.instance().project
+        if project is not None:
+            eventloop.run(self.run_ocr(project.pages))
+
+    async def run_ocr(self, pages: list[Page], doc: Optional[KritaDocument] = None):
+        async def recognize(doc: KritaDocument):
+            if doc.filename == self.current_page_fn:
+                return await self.fill_sources(doc)
+            return await recognize_page_json(doc)
+
+        self.status_label.setText("Recognizing text...")
+        try:
+            count = await recognize(doc) if doc else await process_pages(pages, recognize)
+            self.status_label.setText(f"Recognized {count} texts")
+        except Exception as e:
+            log.exception(f"OCR failed: {e}")
+            self.status_label.setText(f"OCR failed: {e}")
+
+    @ensure_active_document
+    def translate_page(self, doc: KritaDocument):
+        eventloop.run(self.run_translation([], doc))
+
+    def translate_chapter(self):
+        project = ProjectWatcher.instance().project
+        if project is not None:
+            eventloop.run(self.run_translation(project.pages))
+
+    async def run_translation(self, pages: list[Page], doc: Optional[KritaDocument] = None):
+        backend = translation.backend_from_settings()
+        if backend is None:
+            self.status_label.setText("No translation server configured")
+            return
+        # One translator for all pages, so identical texts on different pages are sent once
+        translator = translation.Translator(backend)
+
+        async def translate(doc: KritaDocument):
+            if doc.filename == self.current_page_fn:
+                return await self.fill_translations(translator)
+            return await translate_page_json(doc, translator)
+
+        self.status_label.setText("Translating...")
+        try:
+            count = await translate(doc) if doc else await process_pages(pages, translate)
+            self.status_label.setText(f"Translated {count} texts in {translator.requests} requests")
+        except Exception as e:
+            log.exception(f"Translation failed: {e}")
+            self.status_label.setText(f"Translation failed: {e}")
+
+    async def fill_translations(self, translator: "translation.Translator") -> int:
+        pairs = [p for p in self.translation_pairs
+                 if p.source_text.toPlainText() and not p.translated_text.toPlainText()]
+        texts = await translator.translate([p.source_text.toPlainText() for p in pairs])
+        for pair, text in zip(pairs, texts):
+            pair.translated_text.setPlainText(text)
+        self.watcher.wake()
+        return len(pairs)
+
+    async def fill_sources(self, doc: KritaDocument) -> int:
+        pairs = [p for p in self.translation_pairs if not p.source_text.toPlainText()]
+        texts = await recognize_sources(doc, [p.uid for p in pairs])
+        for pair in pairs:
+            if pair.uid in texts:
+                pair.source_text.setPlainText(texts[pair.uid])
+        self.watcher.wake()
+        return len(texts)
+
     def get_text_bounds(self, doc: KritaDocument) -> tuple[float, float, float, float]:
         if doc.layers.active.parent_layer and doc.layers.active.parent_layer.name == MASK_GRP_NAME:
-            bounds = doc.layers.active.bounds
+            bounds = doc.layers.active.compute_bounds()
             return bounds.offset[0], bounds.offset[1], bounds.extent[0], bounds.extent[1]
         return 100, 100, 200, 100
 
-    def add_pair_to_list(self, pair: TranslationPair):
+    def add_pair_to_list(self, pair: TranslationPair, refresh=True):
         item = QListWidgetItem(self.pair_list)
         self.pair_list.setItemWidget(item, pair)
         item.setSizeHint(pair.sizeHint())
         pair.source_text.focus_in.connect(lambda: item.setSelected(True))
         pair.translated_text.focus_in.connect(lambda: item.setSelected(True))
-        self.update_text_list()
+        if refresh:
+            self.update_text_list()
 
     def update_text_list(self):
         mode = self.text_selector.currentText()
@@ -339,11 +704,6 @@ class TranslateDocker(DockWidget):
             pair.translated_text.setVisible(mode in ["Both", "Translated Only"])
             pair.translated_text.setFont(QFont(pair.font, UI_FONT_SIZE))
 
-    def get_next_number(self, group: GroupLayer) -> int:
-        numbers = [int_tryparse(node.name().rsplit(" ", 1)[-1]) for node in group.childNodes()]
-        numbers = [num for num in numbers if num is not None]
-        return max(numbers + [0]) + 1
-
     def update_pair_styles(self):
         font = self.font_selector.currentFont().family()
         size = self.font_size_selector.value()
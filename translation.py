@@ -0,0 +1,208 @@
+"""Machine translation of source texts.
+
+All texts requested while translating a page or chapter go through one Translator. It answers
+from a persistent cache where possible, merges identical texts (also across pages processed
+concurrently), packs the rest into size-bounded batches and keeps a bounded number of batches
+in flight. Backends reuse their connections between batches.
+"""
+from __future__ import annotations
+import asyncio
+import http.client
+from abc import ABC, abstractmethod
+import json
+import queue
+import threading
+from collections import deque
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from .commons.settings import settings
+from .commons.util import user_data_dir, client_logger as log
+from .commons import executor
+
+
+class TranslationBackend(ABC):
+    """Translates a batch of texts."""
+
+    name: str
+
+    @abstractmethod
+    async def translate(self, texts: list[str]) -> list[str]: ...
+
+
+class HttpTranslation(TranslationBackend):
+    """Posts {"source": lang, "target": lang, "texts": [...]} to a server which replies with a
+    JSON list of translations. Keeps up to `connections` keep-alive connections open."""
+
+    timeout = 120
+
+    def __init__(self, url: str, source: str, target: str, connections=4):
+        parts = urlsplit(url if "://" in url else f"http://{url}")
+        self._https = parts.scheme == "https"
+        self._host = parts.netloc
+        self._path = parts.path or "/"
+        self.source = source
+        self.target = target
+        self.name = f"http:{url}:{source}>{target}"
+        self._idle: queue.LifoQueue[http.client.HTTPConnection] = queue.LifoQueue(connections)
+
+    async def translate(self, texts: list[str]) -> list[str]:
+        return await executor.run_in_thread(self._post, texts)
+
+    def _connect(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            cls = http.client.HTTPSConnection if self._https else http.client.HTTPConnection
+            return cls(self._host, timeout=self.timeout)
+
+    def _release(self, connection: http.client.HTTPConnection):
+        try:
+            self._idle.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def _post(self, texts: list[str]):
+        body = json.dumps({"source": self.source, "target": self.target, "texts": texts})
+        headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+        connection = self._connect()
+        try:
+            for attempt in range(2):
+                try:
+                    connection.request("POST", self._path, body.encode(), headers)
+                    response = connection.getresponse()
+                    data = response.read()
+                    break
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    # Server closed an idle keep-alive connection, reconnect once
+                    connection.close()
+                    if attempt == 1:
+                        raise
+        except Exception:
+            connection.close()
+            raise
+        self._release(connection)
+        if response.status != 200:
+            raise RuntimeError(f"Translation server replied {response.status} {response.reason}")
+        result = json.loads(data)
+        if not isinstance(result, list) or len(result) != len(texts):
+            raise ValueError(f"Translation server returned {result!r:.200} for {len(texts)} texts")
+        return [str(t) for t in result]
+
+
+def backend_from_settings() -> TranslationBackend | None:
+    if settings.translation_url:
+        return HttpTranslation(
+            settings.translation_url,
+            settings.translation_source_language,
+            settings.translation_target_language,
+        )
+    return None
+
+
+class TranslationCache:
+    """Translations keyed by (engine, source) in an append-only JSON lines file."""
+
+    def __init__(self, path: Path = user_data_dir / "translation_cache.jsonl"):
+        self.path = path
+        self._entries: dict[tuple[str, str], str] | None = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        entries = {}
+        if self.path.exists():
+            with open(self.path, "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        e = json.loads(line)
+                        entries[(e["engine"], e["source"])] = e["text"]
+                    except (ValueError, KeyError):
+                        continue  # Torn last line after a crash
+        return entries
+
+    def get(self, engine: str, source: str) -> str | None:
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._load()
+            return self._entries.get((engine, source))
+
+    def put_all(self, engine: str, items: list[tuple[str, str]]):
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._load()
+            lines = []
+            for source, text in items:
+                self._entries[(engine, source)] = text
+                lines.append(json.dumps({"engine": engine, "source": source, "text": text}))
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write("".join(line + "\n" for line in lines))
+
+
+cache = TranslationCache()
+
+
+class Translator:
+    """Coalesces translation requests, see module description."""
+
+    def __init__(
+        self,
+        backend: TranslationBackend,
+        max_in_flight=4,
+        max_batch_items=64,
+        max_batch_chars=4000,
+    ):
+        self.backend = backend
+        self.max_batch_items = max_batch_items
+        self.max_batch_chars = max_batch_chars
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._pending: dict[str, asyncio.Future[str]] = {}
+        self._queue: deque[str] = deque()
+        self._flush_scheduled = False
+        self.requests = 0
+
+    async def translate(self, texts: list[str]) -> list[str]:
+        return list(await asyncio.gather(*(self._request(t) for t in texts)))
+
+    def _request(self, text: str) -> asyncio.Future[str]:
+        loop = asyncio.get_running_loop()
+        if future := self._pending.get(text):
+            return future
+        future = loop.create_future()
+        cached = cache.get(self.backend.name, text) if text.strip() else text
+        if cached is not None:
+            future.set_result(cached)
+            return future
+        self._pending[text] = future
+        self._queue.append(text)
+        if not self._flush_scheduled:
+            # Collect everything requested in this iteration of the event loop first
+            self._flush_scheduled = True
+            loop.call_soon(self._flush)
+        return future
+
+    def _flush(self):
+        self._flush_scheduled = False
+        while self._queue:
+            batch, chars = [], 0
+            while self._queue and len(batch) < self.max_batch_items:
+                size = len(self._queue[0])
+                if batch and chars + size > self.max_batch_chars:
+                    break
+                batch.append(self._queue.popleft())
+                chars += size
+            asyncio.ensure_future(self._send(batch))
+
+    async def _send(self, batch: list[str]):
+        async with self._slots:
+            self.requests += 1
+            try:
+                results = await self.backend.translate(batch)
+            except Exception as e:
+                log.error(f"Translation of {len(batch)} texts failed: {e}")
+                for text in batch:
+                    self._pending.pop(text).set_exception(e)
+                return
+        cache.put_all(self.backend.name, list(zip(batch, results)))
+        for text, result in zip(batch, results):
+            self._pending.pop(text).set_result(result)